@@ -1 +1,2 @@
-from . import controllers
\ No newline at end of file
+from . import controllers
+from . import models
@@ -13,16 +13,23 @@
     'website': "https://www.cier.tech",
     'category': 'Sales',
     'version': '13.0.1.0.1',
-    'depends': ['portal'],
+    # informes_encuestas define informes.encuestas.merge, .maquinarias, .equipos y .tipo.encuesta.portal
+    'depends': ['portal', 'informes_encuestas'],
     'data': [
+        'security/ir.model.access.csv',
+        'data/ultimo_certificado_data.xml',
+        'data/ir_cron_data.xml',
         'report/qrcode.xml',
         'report/qrcode_backend15.xml',
         'report/qrcode_backend35.xml',
         'report/qrcode_backend50.xml',
         'report/qrcode_backend95.xml',
+        'views/api_token_views.xml',
+        'views/portal_assets.xml',
         'views/templates.xml',
          'views/templates_personas.xml',
          'views/templates_oiso.xml',
+         'views/templates_vencimientos.xml',
              ],
     'installable': True,
     'application': True,
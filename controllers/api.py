@@ -0,0 +1,85 @@
+from logging import getLogger
+
+from odoo import http, fields
+from odoo.http import request
+from .instrumentacion import instrumentar
+import json
+
+_logger = getLogger(__name__)
+
+API_LIMIT_DEFAULT = 200
+API_LIMIT_MAX = 1000
+
+
+class CertificaPortalApi(http.Controller):
+
+    def _respuesta_json(self, data, status=200):
+        return request.make_response(json.dumps(data), headers=[('Content-Type', 'application/json')], status=status)
+
+    def _cliente_token(self):
+        autorizacion = request.httprequest.headers.get('Authorization', '')
+        token = autorizacion[7:].strip() if autorizacion.startswith('Bearer ') else ''
+        return request.env['certifica.portal.api.token'].sudo()._cliente_por_token(token)
+
+    @http.route('/api/certifica/v1/<string:ruta_url>/activos', type='http', auth="public", methods=['GET'], csrf=False)
+    @instrumentar
+    def api_activos(self, cursor=None, limit=None, updated_since=None, **kwargs):
+        # Equipos/personas del cliente del token con su último certificado, paginados por cursor
+        cliente_id = self._cliente_token()
+        if not cliente_id:
+            return self._respuesta_json({'error': 'Token inválido'}, status=401)
+        strurl = kwargs.get('ruta_url')
+        TipoPortal = request.env['informes.encuestas.tipo.encuesta.portal'].sudo()
+        tipo_id = TipoPortal._portal_tipo_id(strurl)
+        if not tipo_id:
+            return self._respuesta_json({'error': 'Tipo de documento desconocido'}, status=404)
+        try:
+            cursor = int(cursor or 0)
+            limit = min(int(limit or API_LIMIT_DEFAULT), API_LIMIT_MAX)
+            updated_since = fields.Datetime.to_datetime(updated_since) if updated_since else None
+        except ValueError:
+            return self._respuesta_json({'error': 'Parámetros inválidos'}, status=400)
+        if limit < 1:
+            return self._respuesta_json({'error': 'limit debe estar entre 1 y %s' % API_LIMIT_MAX}, status=400)
+
+        # Valor a usar como updated_since en la próxima sincronización incremental
+        sincronizado_hasta = fields.Datetime.now()
+        personas = strurl=='personas'
+        filas = request.env['certifica.portal.ultimo.certificado'].sudo()._api_pagina(
+            cliente_id, tipo_id, personas, cursor, limit, updated_since=updated_since)
+        urlbase = request.env['ir.config_parameter'].sudo().get_param('web.base.url')
+        data = []
+        for fila in filas:
+            certificado = fila.certificado_id
+            if personas:
+                activo = {
+                    'id': fila.personas_id.id,
+                    'nombre': fila.personas_id.name,
+                    'vat': fila.personas_id.vat,
+                }
+                url = str(urlbase)+'/web/certificado_current/download_pdf/'+str(certificado.id)
+            else:
+                maquinaria = fila.xmaquinaria
+                activo = {
+                    'id': maquinaria.id,
+                    'tipo': maquinaria.equipotipo_id.name,
+                    'marca': maquinaria.marca_id.name,
+                    'modelo': maquinaria.modelo,
+                    'serie': maquinaria.name,
+                    'sku': maquinaria.sku,
+                }
+                url = str(urlbase)+'/web/ultimocertificado/'+str(strurl)+'/'+str(maquinaria.id)+'/'+str(cliente_id)
+            activo['certificado'] = {
+                'id': certificado.id,
+                'codigo': certificado.codigocliente,
+                'fecha_vigencia': fields.Date.to_string(certificado.fecha_vigencia) or None,
+                'fecha_monitoreo': fields.Date.to_string(certificado.fecha_monitoreo) or None,
+                'url': url,
+            }
+            data.append(activo)
+
+        return self._respuesta_json({
+            'data': data,
+            'next_cursor': str(filas[-1].id) if len(filas) == limit else None,
+            'sincronizado_hasta': fields.Datetime.to_string(sincronizado_hasta),
+        })
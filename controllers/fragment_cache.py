@@ -0,0 +1,99 @@
+from logging import getLogger
+
+from collections import OrderedDict
+from contextlib import closing
+import hashlib
+import sqlite3
+import threading
+import time
+
+_logger = getLogger(__name__)
+
+# Cambiar si se modifican las plantillas parciales para descartar lo ya renderizado
+CACHE_VERSION = 1
+DEFAULT_MAX_ENTRIES = 2000
+
+
+# Caché de fragmentos HTML ya renderizados (filas de los listados, historial y resumen del detalle).
+# Nivel 1: LRU en memoria del proceso, acotado por número de entradas. Nivel 2 opcional: un archivo
+# SQLite compartido por los workers del servidor, indicado en el parámetro
+# custom_certifica_portal.fragment_cache_sqlite.
+# Las claves incluyen el write_date de los registros mostrados: al modificarse cambian de clave y
+# las entradas viejas salen por LRU.
+class FragmentCache(object):
+
+    hits = 0
+    misses = 0
+    _lock = threading.Lock()
+    _entries = OrderedDict()
+
+    def __init__(self, env):
+        ICP = env['ir.config_parameter'].sudo()
+        self.dbname = env.cr.dbname
+        self.max_entries = int(ICP.get_param('custom_certifica_portal.fragment_cache_size', DEFAULT_MAX_ENTRIES))
+        self.sqlite_path = ICP.get_param('custom_certifica_portal.fragment_cache_sqlite') or None
+
+    def key(self, *parts):
+        return hashlib.sha1(repr((CACHE_VERSION, self.dbname) + parts).encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+        if html is None and self.sqlite_path:
+            html = self._sqlite_get(key)
+            if html is not None:
+                self._memoria_set(key, html)
+        with self._lock:
+            if html is None:
+                FragmentCache.misses += 1
+            else:
+                FragmentCache.hits += 1
+        _logger.debug('Caché de fragmentos: %s %s (aciertos=%s, fallos=%s)',
+                      'acierto' if html is not None else 'fallo', key,
+                      FragmentCache.hits, FragmentCache.misses)
+        return html
+
+    def set(self, key, html):
+        if self.max_entries <= 0:
+            return
+        self._memoria_set(key, html)
+        if self.sqlite_path:
+            self._sqlite_set(key, html)
+
+    def _memoria_set(self, key, html):
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _conexion(self):
+        conexion = sqlite3.connect(self.sqlite_path, timeout=1)
+        conexion.execute('CREATE TABLE IF NOT EXISTS fragmentos (clave TEXT PRIMARY KEY, html TEXT, usado REAL)')
+        return conexion
+
+    def _sqlite_get(self, key):
+        try:
+            with closing(self._conexion()) as conexion, conexion:
+                fila = conexion.execute('SELECT html FROM fragmentos WHERE clave = ?', (key,)).fetchone()
+                if fila:
+                    conexion.execute('UPDATE fragmentos SET usado = ? WHERE clave = ?', (time.time(), key))
+                    return fila[0]
+        except sqlite3.Error:
+            _logger.warning('No se pudo leer la caché de fragmentos %s', self.sqlite_path, exc_info=True)
+        return None
+
+    def _sqlite_set(self, key, html):
+        try:
+            with closing(self._conexion()) as conexion, conexion:
+                conexion.execute('INSERT OR REPLACE INTO fragmentos (clave, html, usado) VALUES (?, ?, ?)',
+                                 (key, html, time.time()))
+                # Se eliminan primero las menos usadas recientemente
+                conexion.execute("""
+                    DELETE FROM fragmentos WHERE clave IN (
+                        SELECT clave FROM fragmentos ORDER BY usado DESC LIMIT -1 OFFSET ?)
+                """, (self.max_entries,))
+        except sqlite3.Error:
+            _logger.warning('No se pudo guardar el fragmento %s en caché', key, exc_info=True)
@@ -0,0 +1,102 @@
+from logging import getLogger
+
+from odoo.http import request
+from odoo.tools import str2bool
+from contextlib import contextmanager
+import functools
+import threading
+import time
+
+_logger = getLogger(__name__)
+
+
+@contextmanager
+def medir_render():
+    # Acumula en el hilo actual el tiempo de renderizado de informes (PDF / QWeb)
+    hilo = threading.current_thread()
+    inicio = time.time()
+    try:
+        yield
+    finally:
+        hilo.certifica_render_time = getattr(hilo, 'certifica_render_time', 0.0) + time.time() - inicio
+
+
+def instrumentar(func):
+    # Mide tiempo total, consultas SQL, renderizado y bytes de la respuesta de una ruta del portal.
+    # Se registra en una línea de log clave=valor y, si está activo el parámetro
+    # custom_certifica_portal.server_timing, en la cabecera Server-Timing.
+    # request.render es diferido (las herencias aún pueden cambiar qcontext): en ese caso la medición
+    # se cierra cuando Odoo renderiza la respuesta.
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        hilo = threading.current_thread()
+        hilo.certifica_render_time = 0.0
+        medicion = (time.time(), getattr(hilo, 'query_count', 0), getattr(hilo, 'query_time', 0.0))
+        try:
+            response = func(self, *args, **kwargs)
+        except Exception:
+            _publicar(func.__name__, kwargs, medicion, None)
+            raise
+        if getattr(response, 'is_qweb', False):
+            flatten = response.flatten
+
+            def flatten_medido():
+                pendiente = bool(response.template)
+                with medir_render():
+                    flatten()
+                if pendiente:
+                    _publicar(func.__name__, kwargs, medicion, response)
+            response.flatten = flatten_medido
+        else:
+            _publicar(func.__name__, kwargs, medicion, response)
+        return response
+    return wrapper
+
+
+def _publicar(ruta, kwargs, medicion, response):
+    inicio, consultas_inicio, sql_inicio = medicion
+    hilo = threading.current_thread()
+    total = time.time() - inicio
+    consultas = getattr(hilo, 'query_count', 0) - consultas_inicio
+    sql = getattr(hilo, 'query_time', 0.0) - sql_inicio
+    render = getattr(hilo, 'certifica_render_time', 0.0)
+    size = None
+    if response is not None and hasattr(response, 'headers'):
+        size = response.headers.get('Content-Length')
+        if size is None and not getattr(response, 'direct_passthrough', False):
+            size = response.calculate_content_length()
+        if _server_timing():
+            response.headers['Server-Timing'] = 'app;dur=%.1f, sql;dur=%.1f;desc="%s queries", render;dur=%.1f' % (
+                total * 1000, sql * 1000, consultas, render * 1000)
+    _registrar(ruta, kwargs, total, consultas, sql, render, size, response is not None)
+
+
+def _server_timing():
+    # Desactivado por defecto: la cabecera también llega a usuarios anónimos
+    try:
+        return str2bool(request.env['ir.config_parameter'].sudo().get_param('custom_certifica_portal.server_timing', 'False'))
+    except Exception:
+        return False
+
+
+def _registrar(ruta, kwargs, total, consultas, sql, render, size, ok):
+    try:
+        umbral = float(request.env['ir.config_parameter'].sudo().get_param(
+            'custom_certifica_portal.slow_request_ms', 0) or 0)
+    except Exception:
+        umbral = 0
+    total_ms = total * 1000
+    if umbral and total_ms < umbral:
+        return
+    log = _logger.warning if umbral else _logger.info
+    # Las rutas /my/... no reciben userid: el cliente es la empresa del usuario del portal
+    cliente = kwargs.get('userid')
+    if not cliente:
+        try:
+            user = request.env.user
+            cliente = user.partner_id.commercial_partner_id.id if request.uid and not user._is_public() else '-'
+        except Exception:
+            cliente = '-'
+    log('portal_perf ruta=%s tipo=%s uid=%s cliente=%s ok=%s wall_ms=%.1f sql_count=%s sql_ms=%.1f render_ms=%.1f bytes=%s',
+        ruta, kwargs.get('ruta_url', '-'), request.uid, cliente, ok,
+        total_ms, consultas, sql * 1000, render * 1000, size if size is not None else '-')
@@ -6,18 +6,104 @@ from odoo.addons.portal.controllers.portal import CustomerPortal, pager as porta
 from collections import OrderedDict
 from odoo.osv.expression import OR
 from odoo.exceptions import AccessError, MissingError
+from .fragment_cache import FragmentCache
+from .instrumentacion import instrumentar, medir_render
+from .qr_label_cache import QrLabelCache
+from .qr_render_queue import ColaLlena, QrRenderQueue
+from ..models.certifica_portal_vencimiento import SIN_SEDE, TRAMOS_VENCIMIENTO
+from ..models.qr_images import QR_CAMPOS, QR_TAMANOS, generar_qr_lote
 import base64
+import codecs
+import csv
 import logging
 import werkzeug
+import werkzeug.exceptions
+import werkzeug.http
+import werkzeug.urls
+import werkzeug.utils
 import io
+import json
+import odoo
+import os
+import re
+import tempfile
+import threading
+import time
+import zipfile
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
 
 _logger = getLogger(__name__)
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+ZIP_BATCH_SIZE = 500
+HISTORIAL_PAGE_SIZE = 20
+EXPORT_BATCH_SIZE = 2000
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+RESOLVER_CACHE_SIZE = 10000
+# Una etiqueta encolada por otro worker cuya marca no se renueva en este tiempo se da por abandonada
+QR_JOB_TIMEOUT = 600
+
+# Caché en proceso de la resolución "último certificado" -> URL versionada: {clave: (expira, url)}
+_urls_resueltas = OrderedDict()
+_urls_resueltas_lock = threading.Lock()
+
+# Columnas de la exportación del listado: (título, campo)
+COLUMNAS_EXPORTACION = {
+    'maquinarias': [
+        ('Tipo', 'equipotipo_id'),
+        ('Marca', 'marca_id'),
+        ('Modelo', 'modelo'),
+        ('Serie', 'name'),
+        ('SKU/Material Number', 'sku'),
+        ('Serial Number TCTP', 'kit'),
+        ('Observaciones', 'observacion'),
+    ],
+    'personas': [
+        ('DNI', 'vat'),
+        ('Nombres', 'name'),
+        ('Email', 'email'),
+        ('Teléfono', 'phone'),
+        ('Puesto de trabajo', 'function'),
+    ],
+}
+COLUMNAS_CERTIFICADO = [
+    ('Último certificado', 'codigocliente'),
+    ('Fecha de monitoreo', 'fecha_monitoreo'),
+    ('Fecha de vigencia', 'fecha_vigencia'),
+]
+
+# Destino no posicionable para zipfile: acumula lo escrito hasta que se envía
+class _SalidaZip(object):
+
+    def __init__(self):
+        self.partes = []
+        self.size = 0
+
+    def write(self, data):
+        self.partes.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def vaciar(self):
+        data = b''.join(self.partes)
+        self.partes = []
+        self.size = 0
+        return data
+
+
 class ProductPlannerPortal(CustomerPortal):
     _inherit = 'ir.actions.report'
 
     @http.route(['/web/ultimocertificado/<string:ruta_url>/<string:id>/<string:userid>/<string:ruta_urlqr>',
                  '/web/ultimocertificado/<string:ruta_url>/<string:id>/<string:userid>/<string:ruta_urlqr>/<string:idcertificado>'], type='http', auth="user",website=True)
+    @instrumentar
     def print_qrcode(self,**kwargs):
         strurlruta = kwargs.get('ruta_url')
         strurl = kwargs.get('ruta_urlqr')
@@ -26,23 +112,12 @@ class ProductPlannerPortal(CustomerPortal):
         xuserid = kwargs.get('userid')
         report_name = 'custom_certifica_portal.print_qr'
 
-        urlbase = request.env['ir.config_parameter'].sudo().search([('key','=','web.base.url')])
+        urlbase = self._url_base()
         if strurlruta=='personas':
-            xurldownload = str(urlbase.value)+'/web/certificado_current/download_pdf/'+str(idcertificado)
+            xurldownload = str(urlbase)+'/web/certificado_current/download_pdf/'+str(idcertificado)
         else:
-            xurldownload = str(urlbase.value)+'/web/ultimocertificado/'+str(strurlruta)+'/'+str(xid)+'/'+str(xuserid)
-        if strurl=='print_qr15':
-            w=63
-            h=63
-        if strurl=='print_qr35':
-            w=147
-            h=147
-        if strurl=='print_qr50':
-            w=210
-            h=210
-        if strurl=='print_qr95':
-            w=370
-            h=370
+            xurldownload = str(urlbase)+'/web/ultimocertificado/'+str(strurlruta)+'/'+str(xid)+'/'+str(xuserid)
+        w = h = QR_TAMANOS[strurl][0]
 
         docargs = {
             'xurldownload': xurldownload,
@@ -51,25 +126,164 @@ class ProductPlannerPortal(CustomerPortal):
         }
 
         response = werkzeug.wrappers.Response()
-        if strurlruta=='personas':
-            certificado = request.env['informes.encuestas.merge'].sudo().search(
-                [('personas_id', '=', int(xid))], order='fecha_vigencia desc',limit=1)
-        else:
-            certificado = request.env['informes.encuestas.merge'].sudo().search(
-                [('xmaquinaria', '=', int(xid))], order='fecha_vigencia desc',limit=1)
+        tiposdocumentos = self._tipo_documento(strurlruta)
+        certificado = request.env['certifica.portal.ultimo.certificado']._buscar(
+            int(xuserid), tiposdocumentos.id, int(xid), personas=strurlruta=='personas')
 
         r = certificado
         if r:
-            r = request.env.ref(report_name).sudo().render_qweb_pdf([r.id],docargs)[0]
-            response.data = r
+            # La etiqueta solo depende del certificado, el tamaño, la URL y el logo de la compañía
+            cache = QrLabelCache(request.env)
+            cache_key = cache.key(r.id, strurl, xurldownload, r.company_id.id, str(r.company_id.write_date))
+            data = cache.get(cache_key)
+            if data is None:
+                # wkhtmltopdf corre en la cola acotada, no en este hilo; si termina pronto se devuelve aquí
+                cola = QrRenderQueue(request.env)
+                local = cola.trabajo(cache_key)
+                if (not local or local.evento.is_set()) and cache.pendiente(cache_key, QR_JOB_TIMEOUT):
+                    # Ya la está renderizando otro worker del servidor
+                    return self._respuesta_trabajo_qr(cache_key, 'pendiente')
+                try:
+                    trabajo = cola.encolar(cache, cache_key, request.env.uid, dict(request.env.context), report_name, r.id, docargs)
+                except ColaLlena:
+                    return self._respuesta_cola_llena()
+                espera = float(request.env['ir.config_parameter'].sudo().get_param('custom_certifica_portal.qr_render_wait', 3))
+                if trabajo.evento.wait(espera) and trabajo.estado == 'listo':
+                    data = cache.get(cache_key)
+                if data is None:
+                    return self._respuesta_trabajo_qr(cache_key, trabajo.estado)
+            response.data = data
         else:
             response.data = ''
         response.mimetype = 'application/pdf'
         return response
 
-    @http.route('/web/equipos/download_pdf/<id>', type='http', auth="public",website=True)
-    def download_equipos_patrones_pdf(self,id,**kwargs):
-        equipo = request.env['informes.encuestas.equipos'].sudo().search([('id','=',id)],limit=1)
+    @http.route('/web/etiqueta_qr/<string:job_id>', type='http', auth="user", methods=['GET'])
+    @instrumentar
+    def download_etiqueta_qr(self, job_id, **kwargs):
+        # Descarga de una etiqueta encolada por print_qrcode; mientras no esté lista responde 202
+        cache = QrLabelCache(request.env)
+        try:
+            estado = self._estado_trabajo_qr(cache, job_id)
+            if estado == 'listo':
+                data = cache.get(job_id)
+                if data is not None:
+                    return werkzeug.wrappers.Response(data, mimetype='application/pdf')
+                # Expulsada de la caché entre la consulta del estado y la lectura
+                trabajo = QrRenderQueue(request.env).reanudar(cache, job_id)
+                estado = trabajo.estado if trabajo else None
+        except ColaLlena:
+            return self._respuesta_cola_llena()
+        if estado is None:
+            raise werkzeug.exceptions.NotFound()
+        if estado == 'error':
+            return werkzeug.wrappers.Response('No se pudo generar la etiqueta.', status=500, mimetype='text/plain')
+        return self._respuesta_trabajo_qr(job_id, estado)
+
+    @http.route('/web/etiqueta_qr/<string:job_id>/estado', type='http', auth="user", methods=['GET'])
+    @instrumentar
+    def estado_etiqueta_qr(self, job_id, **kwargs):
+        try:
+            estado = self._estado_trabajo_qr(QrLabelCache(request.env), job_id)
+        except ColaLlena:
+            return self._respuesta_cola_llena()
+        if estado is None:
+            raise werkzeug.exceptions.NotFound()
+        return self._json_trabajo_qr(job_id, estado, 200)
+
+    @http.route('/web/etiquetas_qr/metricas', type='http', auth="user", methods=['GET'])
+    @instrumentar
+    def metricas_etiquetas_qr(self, **kwargs):
+        # Profundidad de la cola y tiempos de espera/renderizado de este proceso, para monitoreo
+        if not request.env.user.has_group('base.group_system'):
+            raise werkzeug.exceptions.Forbidden()
+        return request.make_response(json.dumps(QrRenderQueue(request.env).metricas()),
+                                     headers=[('Content-Type', 'application/json'), ('Cache-Control', 'no-store')])
+
+    def _estado_trabajo_qr(self, cache, job_id):
+        # Estado según este proceso o, si lo encoló otro worker, según la caché y su marca de pendiente.
+        # Un trabajo listo cuyo PDF ya no está o con la marca vencida se vuelve a encolar.
+        if not re.match(r'^[0-9a-f]{40}$', job_id):
+            return None
+        if cache.contiene(job_id):
+            return 'listo'
+        cola = QrRenderQueue(request.env)
+        trabajo = cola.trabajo(job_id)
+        if trabajo and trabajo.estado != 'listo':
+            return trabajo.estado
+        if not trabajo and cache.pendiente(job_id, QR_JOB_TIMEOUT):
+            return 'pendiente'
+        trabajo = cola.reanudar(cache, job_id)
+        return trabajo.estado if trabajo else None
+
+    def _json_trabajo_qr(self, job_id, estado, status, headers=None):
+        url = '/web/etiqueta_qr/%s' % job_id
+        data = {'job_id': job_id, 'estado': estado, 'url_estado': url + '/estado', 'url_descarga': url}
+        return request.make_response(json.dumps(data), status=status, headers=[
+            ('Content-Type', 'application/json'), ('Cache-Control', 'no-store')] + (headers or []))
+
+    def _respuesta_cola_llena(self):
+        return werkzeug.wrappers.Response('Demasiadas etiquetas en cola, intente nuevamente.', status=503,
+                                          headers=[('Retry-After', '10')], mimetype='text/plain')
+
+    def _respuesta_trabajo_qr(self, job_id, estado):
+        # 202 con la URL de descarga; el navegador la vuelve a pedir sola con la cabecera Refresh
+        url = '/web/etiqueta_qr/%s' % job_id
+        return self._json_trabajo_qr(job_id, estado, 202, headers=[('Location', url), ('Refresh', '2; url=%s' % url)])
+
+    @http.route(['/my/<string:ruta_url>/etiquetas/<string:ruta_urlqr>'], type='http', auth="user", methods=['GET'], website=True)
+    @instrumentar
+    def print_qrcode_lote(self, sedecliente=None, **kwargs):
+        partner_id = request.env.user.partner_id
+        if request.env.user.partner_id.parent_id:
+            partner_id = request.env.user.partner_id.parent_id
+
+        strurl = kwargs.get('ruta_url')
+        strurlqr = kwargs.get('ruta_urlqr')
+        if strurlqr not in QR_TAMANOS:
+            raise werkzeug.exceptions.NotFound()
+        size, columnas = QR_TAMANOS[strurlqr]
+        tiposdocumentos = self._tipo_documento(strurl)
+        certificados = request.env['informes.encuestas.merge'].sudo()._portal_ultimos_certificados(
+            partner_id.id, tiposdocumentos.id, personas=strurl=='personas', sedecliente=sedecliente)
+
+        response = werkzeug.wrappers.Response()
+        response.mimetype = 'application/pdf'
+        if not certificados:
+            response.data = ''
+            return response
+
+        urlbase = self._url_base()
+        urls = []
+        for certificado in certificados:
+            if strurl=='personas':
+                urls.append(str(urlbase)+'/web/certificado_current/download_pdf/'+str(certificado.id))
+            else:
+                urls.append(str(urlbase)+'/web/ultimocertificado/'+str(strurl)+'/'+str(certificado.xmaquinaria.id)+'/'+str(partner_id.id))
+
+        inicio = time.time()
+        imagenes = generar_qr_lote(urls, size)
+        etiquetas = [{'doc': certificado, 'qr': qr} for certificado, qr in zip(certificados, imagenes)]
+        docargs = {
+            'filas': [etiquetas[i:i + columnas] for i in range(0, len(etiquetas), columnas)],
+            'h': size,
+            'w': size,
+        }
+        tiempo_qr = time.time() - inicio
+        with medir_render():
+            response.data = request.env.ref('custom_certifica_portal.print_qr_lote').sudo().render_qweb_pdf(certificados.ids, docargs)[0]
+        _logger.info('Hoja de etiquetas QR %s/%s: %s etiquetas, QR en %.2fs, total %.2fs',
+                     strurl, strurlqr, len(etiquetas), tiempo_qr, time.time() - inicio)
+        return response
+
+    def _url_base(self):
+        return request.env['ir.config_parameter'].sudo().get_param('web.base.url')
+
+    def _tipo_documento(self, code):
+        TipoPortal = request.env['informes.encuestas.tipo.encuesta.portal'].sudo()
+        return TipoPortal.browse(TipoPortal._portal_tipo_id(code))
+
+    def _nombre_archivo_equipo(self, equipo):
         filename=''
         if equipo.certificado_calibracion:
             if equipo.equipotipo_id.name:
@@ -81,23 +295,9 @@ class ProductPlannerPortal(CustomerPortal):
             filename += '.pdf'
         else:
             filename = 'PATRON_SIN_NOMBRE.pdf'
+        return filename
 
-        headers=[('Content-Type', 'application/pdf'),('Content-Disposition', 'filename='+filename)]
-        response = werkzeug.wrappers.Response(headers=headers)
-
-        r = equipo.certificado_calibracion
-        if r:
-            response.data = base64.b64decode(r)
-        else:
-            response.data = ''
-        response.mimetype = 'application/pdf'
-
-        return response
-
-    @http.route('/web/certificado_current/download_pdf/<id>', type='http', auth="public",website=True)
-    def download_certificado_current_pdf(self,id,**kwargs):
-        certificado = request.env['informes.encuestas.merge'].sudo().search([('id','=',id)],limit=1)
-
+    def _nombre_archivo_certificado(self, certificado):
         if certificado.file_name_certificado:
             filename = certificado.file_name_certificado
         else:
@@ -105,78 +305,380 @@ class ProductPlannerPortal(CustomerPortal):
                 filename = certificado.codigocliente+'.pdf'
             else:
                 filename = 'CERTIFICADO_SIN_CODIGO.pdf'
+        return filename
+
+    def _adjunto_binario(self, record, field_name):
+        if not record:
+            return request.env['ir.attachment']
+        return request.env['ir.attachment'].sudo().search([
+            ('res_model', '=', record._name),
+            ('res_field', '=', field_name),
+            ('res_id', '=', record.id),
+        ], limit=1)
+
+    def _abrir_adjunto(self, adjunto):
+        # Archivo del filestore sin pasar por base64; los adjuntos guardados en BD se decodifican
+        if adjunto.store_fname:
+            return open(adjunto._full_path(adjunto.store_fname), 'rb'), adjunto.file_size
+        data = base64.b64decode(adjunto.datas or b'')
+        return io.BytesIO(data), len(data)
+
+    def _leer_por_bloques(self, fichero, inicio, longitud):
+        try:
+            fichero.seek(inicio)
+            restante = longitud
+            while restante > 0:
+                bloque = fichero.read(min(DOWNLOAD_CHUNK_SIZE, restante))
+                if not bloque:
+                    break
+                restante -= len(bloque)
+                yield bloque
+        finally:
+            fichero.close()
+
+    def _respuesta_adjunto(self, record, field_name, filename, mimetype='application/pdf', cache_control='public, no-cache', adjunto=None):
+        headers=[('Content-Type', mimetype),('Content-Disposition', 'filename='+filename)]
+        adjunto = adjunto or self._adjunto_binario(record, field_name)
+        if not adjunto:
+            # Campo binario no almacenado como adjunto (o vacío)
+            r = record[field_name] if record else False
+            response = werkzeug.wrappers.Response(headers=headers)
+            response.data = base64.b64decode(r) if r else ''
+            response.mimetype = mimetype
+            return response
+
+        httprequest = request.httprequest
+        etag = adjunto.checksum or '%s-%s' % (adjunto.id, adjunto.file_size)
+        last_modified = adjunto.write_date or adjunto.create_date
+        headers += [
+            ('Accept-Ranges', 'bytes'),
+            ('ETag', werkzeug.http.quote_etag(etag)),
+            ('Last-Modified', werkzeug.http.http_date(last_modified)),
+            ('Cache-Control', cache_control),
+        ]
+
+        if not werkzeug.http.is_resource_modified(httprequest.environ, etag=etag, last_modified=last_modified):
+            return werkzeug.wrappers.Response(status=304, headers=headers[2:])
+
+        fichero, size = self._abrir_adjunto(adjunto)
+        inicio, longitud, status = 0, size, 200
+        rango = httprequest.range
+        if_range = httprequest.if_range
+        if rango and (not if_range or if_range.etag == etag):
+            limites = rango.range_for_length(size)
+            if limites:
+                inicio, fin = limites
+                longitud, status = fin - inicio, 206
+                headers.append(('Content-Range', 'bytes %s-%s/%s' % (inicio, fin - 1, size)))
+            elif len(rango.ranges) == 1:
+                fichero.close()
+                return werkzeug.wrappers.Response(
+                    status=416, headers=[('Content-Range', 'bytes */%s' % size)])
+
+        headers.append(('Content-Length', str(longitud)))
+        return werkzeug.wrappers.Response(
+            self._leer_por_bloques(fichero, inicio, longitud),
+            status=status, headers=headers, direct_passthrough=True)
 
-        r = certificado.x_certificado_publicado_file
-
-        headers=[('Content-Type', 'application/pdf'),('Content-Disposition', 'filename='+filename)]
-        response = werkzeug.wrappers.Response(headers=headers)
-
+    @http.route('/web/equipos/download_pdf/<id>', type='http', auth="public",website=True)
+    @instrumentar
+    def download_equipos_patrones_pdf(self,id,**kwargs):
+        equipo = request.env['informes.encuestas.equipos'].sudo().search([('id','=',id)],limit=1)
+        filename = self._nombre_archivo_equipo(equipo)
+        return self._respuesta_adjunto(equipo, 'certificado_calibracion', filename)
 
-        if r:
-            response.data = base64.b64decode(r)
-        else:
-            response.data = ''
-        response.mimetype = 'application/pdf'
+    @http.route('/web/certificado_current/download_pdf/<id>', type='http', auth="public",website=True)
+    @instrumentar
+    def download_certificado_current_pdf(self,id,**kwargs):
+        def buscar():
+            return self._url_version(request.env['informes.encuestas.merge'].sudo().search([('id','=',id)],limit=1))
+        response = self._redireccion_version(('current', id), buscar)
+        if response:
+            return response
 
-        return response
+        certificado = request.env['informes.encuestas.merge'].sudo().search([('id','=',id)],limit=1)
+        filename = self._nombre_archivo_certificado(certificado)
+        return self._respuesta_adjunto(certificado, 'x_certificado_publicado_file', filename)
 
     @http.route('/web/ultimocertificado/<string:ruta_url>/<string:id>/<string:userid>', type='http', auth="public",website=True)
+    @instrumentar
     def download_certificado_ultimo_pdf(self,**kwargs):
 
         strurl = kwargs.get('ruta_url')
         strmaquinara_id = kwargs.get('id')
-        tiposdocumentos = request.env['informes.encuestas.tipo.encuesta.portal'].sudo().search([('active', '=', True),('code', '=', strurl)],limit=1)
         userid = kwargs.get('userid')
-        if strurl=='personas':
-            slide_slide_obj = request.env['informes.encuestas.merge'].sudo().search(
-                [('xtipodocumento', '=', tiposdocumentos.id),
-                 ('personas_id', '=', int(strmaquinara_id)),
-                 ('cliente_id', '=', int(userid))], order='fecha_vigencia desc',limit=1)
-        else:
-            slide_slide_obj = request.env['informes.encuestas.merge'].sudo().search(
-                [('xtipodocumento', '=', tiposdocumentos.id),
-                 ('xmaquinaria', '=', int(strmaquinara_id)),
-                 ('cliente_id', '=', int(userid))], order='fecha_vigencia desc',limit=1)
 
-        if slide_slide_obj.file_name_certificado:
-            filename = slide_slide_obj.file_name_certificado
-        else:
-            if slide_slide_obj.codigocliente:
-                filename = slide_slide_obj.codigocliente+'.pdf'
-            else:
-                filename = 'CERTIFICADO_SIN_CODIGO.pdf'
+        # Lo que escanean los QR: solo se resuelve cuál es el último certificado y se redirige
+        # a su URL inmutable, que el proxy o la CDN pueden cachear
+        def buscar():
+            tiposdocumentos = self._tipo_documento(strurl)
+            return self._url_version(request.env['certifica.portal.ultimo.certificado']._buscar(
+                int(userid), tiposdocumentos.id, int(strmaquinara_id), personas=strurl=='personas'))
+        response = self._redireccion_version(('ultimo', strurl, strmaquinara_id, userid), buscar)
+        if response:
+            return response
+
+        tiposdocumentos = self._tipo_documento(strurl)
+        slide_slide_obj = request.env['certifica.portal.ultimo.certificado']._buscar(
+            int(userid), tiposdocumentos.id, int(strmaquinara_id), personas=strurl=='personas')
+
+        filename = self._nombre_archivo_certificado(slide_slide_obj)
+        return self._respuesta_adjunto(slide_slide_obj, 'x_certificado_publicado_file', filename)
+
+    @http.route('/web/certificado/<int:certificado_id>/<string:checksum>/<string:filename>', type='http', auth="public")
+    @instrumentar
+    def download_certificado_version(self, certificado_id, checksum, filename, **kwargs):
+        # El contenido de esta URL no cambia nunca: si el PDF se reemplazó, se redirige a la nueva versión
+        certificado = request.env['informes.encuestas.merge'].sudo().browse(certificado_id).exists()
+        adjunto = self._adjunto_binario(certificado, 'x_certificado_publicado_file')
+        if not adjunto or not adjunto.checksum:
+            raise werkzeug.exceptions.NotFound()
+        if adjunto.checksum != checksum:
+            return werkzeug.utils.redirect(self._url_version(certificado, adjunto), 302)
+        return self._respuesta_adjunto(certificado, 'x_certificado_publicado_file', self._nombre_archivo_certificado(certificado),
+                                       cache_control=IMMUTABLE_CACHE_CONTROL, adjunto=adjunto)
+
+    def _url_version(self, certificado, adjunto=None):
+        # URL del PDF publicado con el checksum del adjunto: cambia cuando cambia el contenido
+        adjunto = adjunto or self._adjunto_binario(certificado, 'x_certificado_publicado_file')
+        if not adjunto or not adjunto.checksum:
+            return None
+        filename = self._nombre_archivo_certificado(certificado).replace('/', '-')
+        return '/web/certificado/%s/%s/%s' % (certificado.id, adjunto.checksum, werkzeug.urls.url_quote(filename, safe=''))
+
+    def _redireccion_version(self, clave, buscar):
+        # 302 a la URL versionada; la resolución se guarda unos segundos en el proceso para que
+        # las ráfagas de escaneos no consulten la base de datos. None si no hay versión que servir.
+        ttl = int(request.env['ir.config_parameter'].sudo().get_param('custom_certifica_portal.resolver_ttl', 60))
+        clave = (request.env.cr.dbname,) + clave
+        ahora = time.time()
+        url = None
+        with _urls_resueltas_lock:
+            entrada = _urls_resueltas.get(clave)
+            if entrada and entrada[0] > ahora:
+                _urls_resueltas.move_to_end(clave)
+                url = entrada[1]
+        if not url:
+            url = buscar()
+            if not url:
+                return None
+            if ttl > 0:
+                with _urls_resueltas_lock:
+                    _urls_resueltas[clave] = (ahora + ttl, url)
+                    _urls_resueltas.move_to_end(clave)
+                    while len(_urls_resueltas) > RESOLVER_CACHE_SIZE:
+                        _urls_resueltas.popitem(last=False)
+        response = werkzeug.utils.redirect(url, 302)
+        # La respuesta solo depende de la URL pedida
+        response.headers['Cache-Control'] = 'public, max-age=%s' % max(ttl, 0)
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
 
-        headers=[('Content-Type', 'application/pdf'),('Content-Disposition', 'filename='+filename)]
-        response = werkzeug.wrappers.Response(headers=headers)
+    @http.route('/web/certificado_qr/<int:certificado_id>/<string:ruta_urlqr>', type='http', auth="public")
+    @instrumentar
+    def download_certificado_qr(self, certificado_id, ruta_urlqr, **kwargs):
+        # Imagen QR precalculada por el cron; mientras no exista se usa el generador en vivo
+        if ruta_urlqr not in QR_CAMPOS:
+            raise werkzeug.exceptions.NotFound()
+        certificado = request.env['informes.encuestas.merge'].sudo().browse(certificado_id).exists()
+        if not certificado:
+            raise werkzeug.exceptions.NotFound()
+        campo = QR_CAMPOS[ruta_urlqr]
+        if campo in certificado._fields and self._adjunto_binario(certificado, campo):
+            # La URL no cambia cuando se regenera el QR (cliente, tipo o equipo/persona modificados):
+            # no-cache con ETag revalida en cada uso y responde 304 mientras sea el mismo
+            return self._respuesta_adjunto(certificado, campo, '%s-%s.png' % (campo, certificado.id),
+                                           mimetype='image/png')
+        size = QR_TAMANOS[ruta_urlqr][0]
+        return werkzeug.utils.redirect('/report/barcode/?%s' % werkzeug.urls.url_encode({
+            'type': 'QR', 'value': certificado._portal_url_qr(), 'width': size, 'height': size}))
+
+    @http.route(['/my/<string:ruta_url>/zip'], type='http', auth="user", methods=['GET'], website=True)
+    @instrumentar
+    def download_certificados_zip(self, sedecliente=None, fecha_desde=None, fecha_hasta=None, campo_fecha='fecha_vigencia', **kwargs):
+        partner_id = request.env.user.partner_id
+        if request.env.user.partner_id.parent_id:
+            partner_id = request.env.user.partner_id.parent_id
 
-        r = slide_slide_obj.x_certificado_publicado_file
-        if r:
-            response.data = base64.b64decode(r)
-        else:
-            response.data = ''
-        response.mimetype = 'application/pdf'
-        return response
+        strurl = kwargs.get('ruta_url')
+        tiposdocumentos = self._tipo_documento(strurl)
+        if campo_fecha not in ('fecha_vigencia', 'fecha_monitoreo'):
+            campo_fecha = 'fecha_vigencia'
+        try:
+            fecha_desde = fields.Date.to_date(fecha_desde) if fecha_desde else None
+            fecha_hasta = fields.Date.to_date(fecha_hasta) if fecha_hasta else None
+        except ValueError:
+            return werkzeug.wrappers.Response('Fecha inválida, use el formato AAAA-MM-DD.', status=400, mimetype='text/plain')
+        domain = [('xtipodocumento', '=', tiposdocumentos.id),('cliente_id', '=', partner_id.id)]
+        if sedecliente:
+            domain += [('sedecliente', '=', sedecliente)]
+        if fecha_desde:
+            domain += [(campo_fecha, '>=', fecha_desde)]
+        if fecha_hasta:
+            domain += [(campo_fecha, '<=', fecha_hasta)]
+
+        # Solo se reúnen nombres y rutas; el contenido se lee al generar el ZIP
+        entradas = []
+        nombres = set()
+        equipos_vistos = set()
+        Merge = request.env['informes.encuestas.merge'].sudo().with_context(bin_size=True)
+        certificado_ids = Merge.search(domain, order='fecha_vigencia desc').ids
+        for i in range(0, len(certificado_ids), ZIP_BATCH_SIZE):
+            certificados = Merge.browse(certificado_ids[i:i + ZIP_BATCH_SIZE])
+            adjuntos = self._adjuntos_binarios(certificados, 'x_certificado_publicado_file')
+            for certificado in certificados:
+                if certificado.id in adjuntos:
+                    entradas.append(self._entrada_zip('certificados', self._nombre_archivo_certificado(certificado),
+                                                      adjuntos[certificado.id], nombres))
+            equipos = certificados.mapped('equipos_ids').filtered(lambda e: e.id not in equipos_vistos)
+            equipos_vistos.update(equipos.ids)
+            adjuntos = self._adjuntos_binarios(equipos, 'certificado_calibracion')
+            for equipo in equipos:
+                if equipo.id in adjuntos:
+                    entradas.append(self._entrada_zip('patrones', self._nombre_archivo_equipo(equipo),
+                                                      adjuntos[equipo.id], nombres))
+            request.env.clear()
+
+        filename = 'certificados_%s.zip' % strurl
+        headers = [('Content-Type', 'application/zip'), ('Content-Disposition', 'attachment; filename=' + filename)]
+        return werkzeug.wrappers.Response(
+            self._zip_por_bloques(entradas, request.env.cr.dbname),
+            headers=headers, direct_passthrough=True)
+
+    def _adjuntos_binarios(self, records, field_name):
+        if not records:
+            return {}
+        adjuntos = request.env['ir.attachment'].sudo().search([
+            ('res_model', '=', records._name),
+            ('res_field', '=', field_name),
+            ('res_id', 'in', records.ids),
+        ])
+        return {adjunto.res_id: adjunto for adjunto in adjuntos}
+
+    def _entrada_zip(self, carpeta, filename, adjunto, nombres):
+        # Evita nombres repetidos dentro del ZIP
+        nombre = '%s/%s' % (carpeta, filename)
+        base, ext = os.path.splitext(nombre)
+        contador = 1
+        while nombre in nombres:
+            contador += 1
+            nombre = '%s (%s)%s' % (base, contador, ext)
+        nombres.add(nombre)
+        ruta = adjunto._full_path(adjunto.store_fname) if adjunto.store_fname else None
+        return nombre, ruta, adjunto.id, adjunto.file_size
+
+    def _zip_por_bloques(self, entradas, dbname):
+        # Se ejecuta al enviar la respuesta, cuando el cursor de la petición ya está cerrado
+        salida = _SalidaZip()
+        with zipfile.ZipFile(salida, 'w', zipfile.ZIP_STORED, allowZip64=True) as archivo:
+            for nombre, ruta, adjunto_id, size in entradas:
+                zinfo = zipfile.ZipInfo(nombre, date_time=time.localtime()[:6])
+                zinfo.file_size = size
+                if ruta:
+                    fichero = open(ruta, 'rb')
+                else:
+                    with odoo.api.Environment.manage(), odoo.registry(dbname).cursor() as cr:
+                        adjunto = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})['ir.attachment'].browse(adjunto_id)
+                        fichero = io.BytesIO(base64.b64decode(adjunto.datas or b''))
+                with fichero, archivo.open(zinfo, 'w') as destino:
+                    for bloque in iter(lambda: fichero.read(DOWNLOAD_CHUNK_SIZE), b''):
+                        destino.write(bloque)
+                        if salida.size >= DOWNLOAD_CHUNK_SIZE:
+                            yield salida.vaciar()
+                yield salida.vaciar()
+        yield salida.vaciar()
 
     @http.route(['/my/<string:ruta_url>','/my/<string:ruta_url>/page/<int:page>'], type='http', auth="user", methods=['GET'], website=True)
+    @instrumentar
     def preference(self,page=1, date_begin=None, date_end=None, sortby=None, filterby=None,search=None, search_in='all', **kwargs):
-        values = self._prepare_portal_layout_values()
         partner_id = request.env.user.partner_id
-        _logger.info("ENTRO POR AQUI ..... X2")
         if request.env.user.partner_id.parent_id:
             partner_id = request.env.user.partner_id.parent_id
 
         strurl = kwargs.get('ruta_url')
-        tiposdocumentos = request.env['informes.encuestas.tipo.encuesta.portal'].sudo().search([('active', '=', True),('code', '=', strurl)],limit=1)
+        tiposdocumentos = self._tipo_documento(strurl)
+        busqueda = self._preference_busqueda(strurl, sortby, filterby, search, search_in, date_begin, date_end)
+        listaids = busqueda['listaids']
+        campo_documento = busqueda['campo_documento']
+        domain = busqueda['domain']
+        order = busqueda['order']
+        sortby = busqueda['sortby']
+        filterby = busqueda['filterby']
+        stridpage = busqueda['stridpage']
+        sedecliente = ''
+        if strurl in ('fisicos','quimicos','biologicos','ergonomicoypsicosocial'):
+            sedecliente = request.env['informes.encuestas.merge'].sudo().search([('xtipodocumento', '=', tiposdocumentos.id),('cliente_id', '=', partner_id.id)], limit=1).sedecliente or ''
+
+        # Filas de la página y total para el pager en una sola consulta; la relación con los
+        # certificados del cliente se resuelve en SQL contra el índice de últimos certificados
+        UltimoCertificado = request.env['certifica.portal.ultimo.certificado']
+        relevancia = busqueda['relevancia']
+        offset = (max(int(page), 1) - 1) * self._items_per_page
+        pagina_ids, maquinas_count = UltimoCertificado._portal_pagina(
+            listaids._name, campo_documento, partner_id.id, tiposdocumentos.id,
+            domain, order, self._items_per_page, offset, relevancia=relevancia)
+        # pager
+        pager = portal_pager(
+            url="/my/"+str(strurl),
+            url_args={'date_begin': date_begin, 'date_end': date_end, 'sortby': sortby},
+            total=maquinas_count,
+            page=page,
+            step=self._items_per_page
+        )
+        if pager['offset'] != offset:
+            pagina_ids, maquinas_count = UltimoCertificado._portal_pagina(
+                listaids._name, campo_documento, partner_id.id, tiposdocumentos.id,
+                domain, order, self._items_per_page, pager['offset'], relevancia=relevancia)
+
+        # content according to pager and archive selected
+        listaids = listaids.browse(pagina_ids)
+        request.session['my_listaids_history'] = listaids.ids[:30]
+
+        # Filas de la tabla desde la caché de fragmentos; la clave cambia con los registros mostrados
+        relaciones = () if strurl=='personas' else ('equipotipo_id', 'marca_id')
+        clave_filas = (partner_id.id, str(partner_id.write_date), strurl, page, sortby, filterby, search, search_in,
+                       date_begin, date_end, sedecliente, tuple(listaids.ids), self._version_registros(listaids, relaciones))
+
+        values = {
+          'date': date_begin,
+          'page_name': tiposdocumentos.title,
+          'pager': pager,
+          'default_url': '/my/'+str(strurl),
+          'strurl':str(strurl),
+          'searchbar_sortings': busqueda['searchbar_sortings'],
+          'sortby': sortby,
+          'search': search,
+          'search_in': search_in,
+          'searchbar_inputs': busqueda['searchbar_inputs'],
+          'searchbar_filters': OrderedDict(sorted(busqueda['searchbar_filters'].items())),
+          'filterby':filterby,
+          'partner_id': partner_id,
+          'listmaquinarias_ids': listaids,
+          'listpersonas_ids': listaids,
+          'sedecliente':sedecliente,
+          'tiposdocumentos' : strurl,
+          'xtiposdocumentos' : tiposdocumentos,
+          'query_exportar': werkzeug.urls.url_encode({k: v for k, v in [
+              ('date_begin', date_begin), ('date_end', date_end), ('sortby', sortby), ('filterby', filterby),
+              ('search', search), ('search_in', search_in)] if v}),
+        }
+        values['filas_html'] = self._fragmento(stridpage + '_filas', clave_filas, values)
+        
+
+
+        return request.render(stridpage, values)
+
+
+    def _preference_busqueda(self, strurl, sortby=None, filterby=None, search=None, search_in='all', date_begin=None, date_end=None):
+        # Dominio, orden y opciones de búsqueda del listado; lo comparten la página y la exportación
         listaids = []
-        sedecliente=''
         stridpage=''
-        listcertificados = request.env['informes.encuestas.merge'].sudo().search([('xtipodocumento', '=', tiposdocumentos.id),('cliente_id', '=', partner_id.id)])
         if strurl=='personas':
             #Personas de Certifica
             stridpage='custom_certifica_portal.page_personas'
-            documentos_ids = listcertificados.mapped('personas_id.id')
-            listaids = request.env['res.partner'].sudo().search([('company_type', '=', 'person')])
-            domain = [('active', '=', (True)),('id', 'in', documentos_ids)]
+            listaids = request.env['res.partner'].sudo()
+            campo_documento = 'personas_id'
+            domain = [('active', '=', (True))]
 
             searchbar_inputs = {
                 'all': {'input': 'all', 'label': _('Búsqueda en todo')},
@@ -205,16 +707,19 @@ class ProductPlannerPortal(CustomerPortal):
                 #'email': {'label': _('Email'), 'order': 'email'},
             }
 
+            if search and request.env['certifica.portal.busqueda']._trigramas_activos():
+                searchbar_sortings['relevancia'] = {'label': _('Relevancia'), 'order': 'name'}
+
             # default sort by order
-            if not sortby:
-                sortby = 'name'
+            if sortby not in searchbar_sortings:
+                sortby = 'relevancia' if 'relevancia' in searchbar_sortings else 'name'
             order = searchbar_sortings[sortby]['order']
 
         else:
             #Certifica y OISO
-            documentos_ids = listcertificados.mapped('xmaquinaria.id')
-            listaids = request.env['informes.encuestas.maquinarias'].sudo().search([])
-            domain = [('active', '=', (True)),('id', 'in', documentos_ids)]
+            listaids = request.env['informes.encuestas.maquinarias'].sudo()
+            campo_documento = 'xmaquinaria'
+            domain = [('active', '=', (True))]
 
             searchbar_sortings = {
                 'equipotipo': {'label': _('Tipo'), 'order': 'equipotipo_id desc'},
@@ -223,14 +728,16 @@ class ProductPlannerPortal(CustomerPortal):
                 'serie': {'label': _('Serie'), 'order': 'name'},
             }
 
+            if search and request.env['certifica.portal.busqueda']._trigramas_activos():
+                searchbar_sortings['relevancia'] = {'label': _('Relevancia'), 'order': 'name'}
+
             # default sort by order
-            if not sortby:
-                sortby = 'equipotipo'
+            if sortby not in searchbar_sortings:
+                sortby = 'relevancia' if 'relevancia' in searchbar_sortings else 'equipotipo'
             order = searchbar_sortings[sortby]['order']
 
             if strurl in ('fisicos','quimicos','biologicos','ergonomicoypsicosocial'): #CERTIFICA - MAQUINARIA
                 stridpage='custom_certifica_portal.page_oiso'
-                sedecliente = listcertificados[0].sedecliente
                 searchbar_inputs = {
                     'all': {'input': 'all', 'label': _('Búsqueda en todo')},
                     'serie': {'input': 'serie', 'label': _('Búsqueda en serie')},
@@ -292,74 +799,204 @@ class ProductPlannerPortal(CustomerPortal):
         if date_begin and date_end:
             domain += [('create_date', '>', date_begin), ('create_date', '<=', date_end)]
 
-        # count for pager
-        maquinas_count = listaids.search_count(domain)
-        # pager
+        relevancia = None
+        if sortby == 'relevancia':
+            relevancia = request.env['certifica.portal.busqueda']._relevancia(listaids._name, search_in, search)
+
+        return {
+            'listaids': listaids,
+            'campo_documento': campo_documento,
+            'stridpage': stridpage,
+            'domain': domain,
+            'order': order,
+            'relevancia': relevancia,
+            'sortby': sortby,
+            'filterby': filterby,
+            'searchbar_sortings': searchbar_sortings,
+            'searchbar_inputs': searchbar_inputs,
+            'searchbar_filters': searchbar_filters,
+        }
+
+    @http.route(['/my/<string:ruta_url>/export/<string:formato>'], type='http', auth="user", methods=['GET'], website=True)
+    @instrumentar
+    def download_listado(self, date_begin=None, date_end=None, sortby=None, filterby=None, search=None, search_in='all', **kwargs):
+        partner_id = request.env.user.partner_id
+        if request.env.user.partner_id.parent_id:
+            partner_id = request.env.user.partner_id.parent_id
+
+        strurl = kwargs.get('ruta_url')
+        formato = kwargs.get('formato')
+        if formato not in ('csv', 'xlsx') or (formato == 'xlsx' and not xlsxwriter):
+            raise werkzeug.exceptions.NotFound()
+        tiposdocumentos = self._tipo_documento(strurl)
+        busqueda = self._preference_busqueda(strurl, sortby, filterby, search, search_in, date_begin, date_end)
+        model_name = busqueda['listaids']._name
+
+        # Misma consulta que la página, sin límite; las filas se leen al generar la respuesta
+        sql, params = request.env['certifica.portal.ultimo.certificado']._portal_exportacion(
+            model_name, busqueda['campo_documento'], partner_id.id, tiposdocumentos.id,
+            busqueda['domain'], busqueda['order'], relevancia=busqueda['relevancia'])
+        columnas = COLUMNAS_EXPORTACION['personas' if strurl=='personas' else 'maquinarias']
+        cabecera = ['RUC Empresa', 'Empresa'] + [columna[0] for columna in columnas] + [columna[0] for columna in COLUMNAS_CERTIFICADO]
+        filas = self._filas_listado(request.env.cr.dbname, dict(request.env.context), model_name, sql, params,
+                                    columnas, [partner_id.vat or '', partner_id.name or ''])
+
+        filename = '%s.%s' % (strurl, formato)
+        if formato == 'csv':
+            datos = self._listado_csv(cabecera, filas)
+            mimetype = 'text/csv; charset=utf-8'
+        else:
+            datos = self._listado_xlsx(cabecera, filas)
+            mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        headers = [('Content-Type', mimetype), ('Content-Disposition', 'attachment; filename=' + filename)]
+        return werkzeug.wrappers.Response(datos, headers=headers, direct_passthrough=True)
+
+    def _filas_listado(self, dbname, context, model_name, sql, params, columnas, empresa):
+        # El generador corre después de cerrar el cursor de la petición: usa uno propio y recorre
+        # la consulta con un cursor con nombre (de servidor), leyendo EXPORT_BATCH_SIZE filas por vez
+        campos = [columna[1] for columna in columnas]
+        campos_certificado = [columna[1] for columna in COLUMNAS_CERTIFICADO]
+        with odoo.api.Environment.manage(), odoo.registry(dbname).cursor() as cr:
+            env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, context)
+            Model = env[model_name]
+            Merge = env['informes.encuestas.merge']
+            with cr._cnx.cursor('certifica_portal_exportacion') as servidor:
+                servidor.itersize = EXPORT_BATCH_SIZE
+                servidor.execute(sql, params)
+                while True:
+                    lote = servidor.fetchmany(EXPORT_BATCH_SIZE)
+                    if not lote:
+                        break
+                    registros = {r['id']: r for r in Model.browse([fila[0] for fila in lote]).read(campos)}
+                    certificados = {c['id']: c for c in Merge.browse([fila[1] for fila in lote if fila[1]]).read(campos_certificado)}
+                    for registro_id, certificado_id in lote:
+                        registro = registros.get(registro_id, {})
+                        certificado = certificados.get(certificado_id, {})
+                        yield empresa + [self._valor_exportacion(registro.get(campo)) for campo in campos] \
+                                      + [self._valor_exportacion(certificado.get(campo)) for campo in campos_certificado]
+                    env.clear()
+
+    def _valor_exportacion(self, valor):
+        if isinstance(valor, tuple):
+            return valor[1]
+        if valor is False or valor is None:
+            return ''
+        return str(valor)
+
+    def _listado_csv(self, cabecera, filas):
+        salida = io.StringIO()
+        escritor = csv.writer(salida)
+        escritor.writerow(cabecera)
+        # BOM para que Excel reconozca UTF-8
+        yield codecs.BOM_UTF8 + salida.getvalue().encode('utf-8')
+        salida.seek(0)
+        salida.truncate()
+        for fila in filas:
+            escritor.writerow(fila)
+            if salida.tell() >= DOWNLOAD_CHUNK_SIZE:
+                yield salida.getvalue().encode('utf-8')
+                salida.seek(0)
+                salida.truncate()
+        yield salida.getvalue().encode('utf-8')
+
+    def _listado_xlsx(self, cabecera, filas):
+        # constant_memory: xlsxwriter vuelca cada fila a un temporal en disco; el libro solo se puede
+        # enviar al cerrarlo, pero las cabeceras HTTP salen de inmediato
+        fd, ruta = tempfile.mkstemp(suffix='.xlsx')
+        os.close(fd)
+        try:
+            libro = xlsxwriter.Workbook(ruta, {'constant_memory': True, 'tmpdir': os.path.dirname(ruta)})
+            hoja = libro.add_worksheet()
+            negrita = libro.add_format({'bold': True})
+            hoja.write_row(0, 0, cabecera, negrita)
+            yield b''
+            for i, fila in enumerate(filas, 1):
+                hoja.write_row(i, 0, fila)
+            libro.close()
+            with open(ruta, 'rb') as fichero:
+                for bloque in iter(lambda: fichero.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    yield bloque
+        finally:
+            os.unlink(ruta)
+
+    @http.route(['/my/<string:ruta_url>/vencimientos', '/my/<string:ruta_url>/vencimientos/page/<int:page>'], type='http', auth="user", methods=['GET'], website=True)
+    @instrumentar
+    def portal_vencimientos(self, page=1, tramo='30', sedecliente=None, **kwargs):
+        partner_id = request.env.user.partner_id
+        if request.env.user.partner_id.parent_id:
+            partner_id = request.env.user.partner_id.parent_id
+
+        strurl = kwargs.get('ruta_url')
+        tiposdocumentos = self._tipo_documento(strurl)
+        tramos = [(codigo, etiqueta) for codigo, etiqueta, desde, hasta in TRAMOS_VENCIMIENTO]
+        if tramo not in dict(tramos):
+            tramo = '30'
+
+        # Conteos desde el resumen precalculado; la lista solo trae la página del tramo elegido
+        Vencimiento = request.env['certifica.portal.vencimiento']
+        resumen = Vencimiento._resumen(partner_id.id, tiposdocumentos.id)
+        totales = {codigo: sum(conteos.get(codigo, 0) for conteos in resumen.values()) for codigo, etiqueta in tramos}
+        offset = (max(int(page), 1) - 1) * self._items_per_page
+        activos, total = Vencimiento._portal_activos(partner_id.id, tiposdocumentos.id, tramo, sedecliente,
+                                                     limit=self._items_per_page, offset=offset)
+
+        def url_vencimientos(codigo, sede=None):
+            # sede: clave del resumen ('' = sin sede) o None para el total de todas las sedes
+            args = {'tramo': codigo}
+            if sede is not None:
+                args['sedecliente'] = sede or SIN_SEDE
+            return '/my/%s/vencimientos?%s' % (strurl, werkzeug.urls.url_encode(args))
+
         pager = portal_pager(
-            url="/my/"+str(strurl),
-            url_args={'date_begin': date_begin, 'date_end': date_end, 'sortby': sortby},
-            total=maquinas_count,
+            url='/my/%s/vencimientos' % strurl,
+            url_args={'tramo': tramo, 'sedecliente': sedecliente},
+            total=total,
             page=page,
             step=self._items_per_page
         )
 
-        ''''''''''''''''''
-
-
-        # content according to pager and archive selected
-        listaids = listaids.search(domain, order=order, limit=self._items_per_page, offset=pager['offset'])
-        request.session['my_listaids_history'] = listaids.ids[:30]
-
         values = {
-          'date': date_begin,
           'page_name': tiposdocumentos.title,
           'pager': pager,
           'default_url': '/my/'+str(strurl),
-          'strurl':str(strurl),
-          'searchbar_sortings': searchbar_sortings,
-          'sortby': sortby,
-          'search': search,
-          'search_in': search_in,
-          'searchbar_inputs': searchbar_inputs,
-          'searchbar_filters': OrderedDict(sorted(searchbar_filters.items())),
-          'filterby':filterby,
+          'strurl': str(strurl),
           'partner_id': partner_id,
-          'listmaquinarias_ids': listaids,
-          'listpersonas_ids': listaids,
-          'sedecliente':sedecliente,
-          'tiposdocumentos' : strurl,
-          'xtiposdocumentos' : tiposdocumentos,
+          'tiposdocumentos': strurl,
+          'xtiposdocumentos': tiposdocumentos,
+          'tramos': tramos,
+          'tramo': tramo,
+          'sedecliente': 'Sin sede' if sedecliente == SIN_SEDE else sedecliente or '',
+          'sede_filtro': '' if sedecliente == SIN_SEDE else sedecliente or None,
+          'url_vencimientos': url_vencimientos,
+          'resumen': resumen,
+          'sedes': sorted(resumen),
+          'totales': totales,
+          'activos': activos,
+          'personas': strurl=='personas',
         }
-        _logger.info('ENTRO D3.....>>' + str(strurl))
-        
-
-
-        return request.render(stridpage, values)
-
+        return request.render('custom_certifica_portal.portal_vencimientos', values)
 
     @http.route(['/my/<string:ruta_url>/<int:maquinara_id>','/my/<string:ruta_url>/page/<string:ruta_url_2>/<int:maquinara_id>'], type='http', auth="user",methods=['GET'], website=True)
+    @instrumentar
     def portal_my_maquinarias_detail(self, **kwargs):
-        _logger.info('ENTRO T4 .... ')
         partner_id = request.env.user.partner_id
         if request.env.user.partner_id.parent_id:
             partner_id = request.env.user.partner_id.parent_id
         strurl = kwargs.get('ruta_url')
         strmaquinara_id = kwargs.get('maquinara_id')
-        tiposdocumentos = request.env['informes.encuestas.tipo.encuesta.portal'].sudo().search([('active', '=', True),('code', '=', strurl)],limit=1)
+        tiposdocumentos = self._tipo_documento(strurl)
         stridpage=''
         persona=''
         maquinaria=''
         if strurl=='personas':
             stridpage='custom_certifica_portal.portal_certificados_page_personas'
             persona = request.env['res.partner'].sudo().search([('id', '=', strmaquinara_id)],limit=1)
-            list_certificado_documento_id = request.env['informes.encuestas.merge'].sudo().search([('xtipodocumento', '=', tiposdocumentos.id),('personas_id', '=', strmaquinara_id),('cliente_id', '=', partner_id.id)], order='fecha_vigencia desc')
 
         else:
             if strurl in ('fisicos','quimicos','biologicos','ergonomicoypsicosocial'):
                 stridpage='custom_certifica_portal.portal_certificados_page_oiso'
             else:
                 stridpage='custom_certifica_portal.portal_certificados_page'
-            list_certificado_documento_id = request.env['informes.encuestas.merge'].sudo().search([('xtipodocumento', '=', tiposdocumentos.id),('xmaquinaria', '=', strmaquinara_id),('cliente_id', '=', partner_id.id)], order='fecha_vigencia desc')
             maquinaria = request.env['informes.encuestas.maquinarias'].sudo().search([('id', '=', strmaquinara_id)],limit=1)
 
         values={}
@@ -369,15 +1006,18 @@ class ProductPlannerPortal(CustomerPortal):
         xultimcertificado=''
         idultimocert=0
         xidultimocert=0
-        if len(list_certificado_documento_id)>0:
-            xidultimocert = list_certificado_documento_id[0]
-            idultimocert = list_certificado_documento_id[0].id
-            xfecvigencia = list_certificado_documento_id[0].fecha_vigencia
-            xfecmonitoreo = list_certificado_documento_id[0].fecha_monitoreo
-            xultimcertificado=list_certificado_documento_id[0].codigocliente
-
-        urlbase = request.env['ir.config_parameter'].sudo().search([('key','=','web.base.url')])
-        xurldownload = str(urlbase.value)+'/web/ultimocertificado/'+str(strurl)+'/'+str(strmaquinara_id)+'/'+str(partner_id.id)
+        ultimo = request.env['certifica.portal.ultimo.certificado']._buscar(
+            partner_id.id, tiposdocumentos.id, int(strmaquinara_id), personas=strurl=='personas')
+        if ultimo:
+            xidultimocert = ultimo
+            idultimocert = ultimo.id
+            xfecvigencia = ultimo.fecha_vigencia
+            xfecmonitoreo = ultimo.fecha_monitoreo
+            xultimcertificado=ultimo.codigocliente
+
+        urlbase = self._url_base()
+        xurldownload = str(urlbase)+'/web/ultimocertificado/'+str(strurl)+'/'+str(strmaquinara_id)+'/'+str(partner_id.id)
+        historial = self._historial_certificados(strurl, int(strmaquinara_id), partner_id, tiposdocumentos, str(urlbase), 0)
 
         ultimocert = {
             'fecha_vigencia' :  xfecvigencia,
@@ -394,13 +1034,112 @@ class ProductPlannerPortal(CustomerPortal):
             'urldownload': xurldownload,
             'partner_id': partner_id,
             'ultimocert' :  ultimocert,
-            'listcertificados_ids': list_certificado_documento_id,
             'strurl':'/my/'+str(strurl),
             'xtiposdocumentos' : tiposdocumentos,
         }
+        values.update(historial)
+        values['filas_html'] = self._filas_historial(strurl, int(strmaquinara_id), partner_id, values)
+        if maquinaria:
+            plantilla = 'custom_certifica_portal.portal_certificados_resumen'
+            if strurl in ('fisicos','quimicos','biologicos','ergonomicoypsicosocial'):
+                plantilla = 'custom_certifica_portal.portal_certificados_resumen_oiso'
+            relaciones_cert = ('xtipoencuesta',) if 'xtipoencuesta' in ultimo._fields else ()
+            clave_resumen = (partner_id.id, str(partner_id.write_date), maquinaria.id,
+                             self._version_registros(maquinaria, ('equipotipo_id', 'marca_id')),
+                             ultimo.id if ultimo else None,
+                             self._version_registros(ultimo, relaciones_cert) if ultimo else None)
+            values['resumen_html'] = self._fragmento(plantilla, clave_resumen, values)
 
         return request.render(stridpage, values)
 
+    @http.route(['/my/<string:ruta_url>/<int:maquinara_id>/certificados'], type='json', auth="user", website=True)
+    @instrumentar
+    def portal_my_maquinarias_certificados(self, offset=0, **kwargs):
+        # Siguiente página del historial de certificados ("Ver más" en el detalle)
+        partner_id = request.env.user.partner_id
+        if request.env.user.partner_id.parent_id:
+            partner_id = request.env.user.partner_id.parent_id
+        strurl = kwargs.get('ruta_url')
+        maquinara_id = kwargs.get('maquinara_id')
+        tiposdocumentos = self._tipo_documento(strurl)
+        try:
+            offset = max(int(offset), 0)
+        except (TypeError, ValueError):
+            offset = 0
+        urlbase = self._url_base()
+        values = self._historial_certificados(strurl, maquinara_id, partner_id, tiposdocumentos, str(urlbase), offset)
+        values['urldownload'] = str(urlbase)+'/web/ultimocertificado/'+str(strurl)+'/'+str(maquinara_id)+'/'+str(partner_id.id)
+        html = self._filas_historial(strurl, maquinara_id, partner_id, values)
+        return {
+            'html': html,
+            'offset': values['certificados_offset'],
+            'mas': values['certificados_mas'],
+        }
+
+    def _filas_historial(self, strurl, maquinara_id, partner_id, values):
+        certificados = values['listcertificados_ids']
+        equipos = certificados.mapped('equipos_ids')
+        clave = (partner_id.id, strurl, maquinara_id, values['certificados_offset'], values['urldownload'],
+                 tuple(certificados.ids), self._version_registros(certificados), self._version_registros(equipos),
+                 tuple(sorted(values['equipos_con_certificado'])))
+        return self._fragmento(self._plantilla_filas_certificados(strurl), clave, values)
+
+    def _fragmento(self, plantilla, clave, values):
+        # HTML de una plantilla parcial desde la caché de fragmentos; si no está, se renderiza con QWeb
+        cache = FragmentCache(request.env)
+        key = cache.key(plantilla, request.env.lang, *clave)
+        html = cache.get(key)
+        if html is None:
+            with medir_render():
+                html = request.env['ir.ui.view'].render_template(plantilla, values)
+            if isinstance(html, bytes):
+                html = html.decode()
+            cache.set(key, html)
+        return html
+
+    def _version_registros(self, records, relaciones=()):
+        # Último write_date de los registros y de los catálogos de sus many2one: al modificarse
+        # cualquiera de ellos cambia la clave del fragmento
+        cr = request.env.cr
+        versiones = []
+        if records:
+            cr.execute('SELECT max(write_date) FROM "%s" WHERE id IN %%s' % records._table, [tuple(records.ids)])
+            versiones.append(cr.fetchone()[0])
+        for campo in relaciones:
+            cr.execute('SELECT max(write_date) FROM "%s"' % request.env[records._fields[campo].comodel_name]._table)
+            versiones.append(cr.fetchone()[0])
+        return tuple(str(version) for version in versiones)
+
+    def _plantilla_filas_certificados(self, strurl):
+        if strurl=='personas':
+            return 'custom_certifica_portal.portal_certificados_filas_personas'
+        if strurl in ('fisicos','quimicos','biologicos','ergonomicoypsicosocial'):
+            return 'custom_certifica_portal.portal_certificados_filas_oiso'
+        return 'custom_certifica_portal.portal_certificados_filas'
+
+    def _historial_certificados(self, strurl, maquinara_id, partner_id, tiposdocumentos, urlbase, offset):
+        # Una página del historial: solo se leen los campos que muestran las filas y la existencia
+        # del certificado de calibración de los patrones se comprueba con sus adjuntos
+        campo = 'personas_id' if strurl=='personas' else 'xmaquinaria'
+        certificados = request.env['informes.encuestas.merge'].sudo().search(
+            [('xtipodocumento', '=', tiposdocumentos.id),(campo, '=', maquinara_id),('cliente_id', '=', partner_id.id)],
+            order='fecha_vigencia desc, id desc', offset=offset, limit=HISTORIAL_PAGE_SIZE + 1)
+        mas = len(certificados) > HISTORIAL_PAGE_SIZE
+        certificados = certificados[:HISTORIAL_PAGE_SIZE]
+        campos = ['codigocliente', 'fecha_monitoreo', 'fecha_vigencia', 'description', 'equipos_ids']
+        if strurl=='personas':
+            campos.append('x_competencias')
+        certificados.read(campos)
+        equipos = certificados.mapped('equipos_ids')
+        return {
+            'listcertificados_ids': certificados,
+            'urls_certificados': {c.id: urlbase+'/web/certificado_current/download_pdf/'+str(c.id) for c in certificados},
+            'equipos_con_certificado': set(self._adjuntos_binarios(equipos, 'certificado_calibracion')),
+            'certificados_mas': mas,
+            'certificados_offset': offset + len(certificados),
+            'url_certificados': '/my/%s/%s/certificados' % (strurl, maquinara_id),
+        }
+
 
 class WebsiteAccount(CustomerPortal):
 
@@ -413,36 +1152,29 @@ class WebsiteAccount(CustomerPortal):
         values = super(WebsiteAccount, self)._prepare_portal_layout_values()
         listtipos=[]
 
-        tiposdocumentos = request.env['informes.encuestas.tipo.encuesta.portal'].sudo() \
-            .search([
-            ('active', '=', True),
-        ])
-
+        # (id, code, title) de los tipos activos, cacheado hasta que se modifique algún tipo
+        tiposdocumentos = request.env['informes.encuestas.tipo.encuesta.portal'].sudo()._portal_tipos_activos()
 
-        for x in tiposdocumentos:
 
-            listcertificados = request.env['informes.encuestas.merge'].sudo() \
-                .search([
-                ('xtipodocumento', '=', x.id),
-                ('cliente_id', '=', partner_id.id),
+        # Conteos de equipos/personas distintos por tipo de documento (cacheado por cliente)
+        conteos = request.env['informes.encuestas.merge'].sudo()._portal_conteo_documentos(partner_id.id)
 
-            ])
+        for tipo_id, tipo_code, tipo_title in tiposdocumentos:
 
-            if x.code=='personas':
-                documentos_ids = listcertificados.mapped('personas_id.id')
-                delivery_dates_count = len(documentos_ids)
+            conteo_maquinarias, conteo_personas = conteos.get(tipo_id, (0, 0))
+            if tipo_code=='personas':
+                delivery_dates_count = conteo_personas
             else:
-                documentos_ids = listcertificados.mapped('xmaquinaria.id')
-                delivery_dates_count = len(documentos_ids)
+                delivery_dates_count = conteo_maquinarias
 
             # Evitar errores si el campo code no es una cadena válida
-            code = x.code if isinstance(x.code, str) and x.code.strip() else None
+            code = tipo_code if isinstance(tipo_code, str) and tipo_code.strip() else None
             if not code:
-                _logger.warning('Tipo de encuesta portal con code inválido: id=%s, code=%s. Se omite en el menú del portal.', x.id, x.code)
+                _logger.warning('Tipo de encuesta portal con code inválido: id=%s, code=%s. Se omite en el menú del portal.', tipo_id, tipo_code)
                 continue
 
             listtipos.append({
-                'title': x.title,
+                'title': tipo_title,
                 'strurl': '/my/' + code,
                 'delivery_dates_count': delivery_dates_count,
             })
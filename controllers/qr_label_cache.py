@@ -0,0 +1,129 @@
+from logging import getLogger
+
+from odoo.tools import config
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+_logger = getLogger(__name__)
+
+# Cambiar si se modifican las plantillas de las etiquetas para descartar lo ya renderizado
+CACHE_VERSION = 1
+DEFAULT_MAX_MB = 200
+
+
+# Caché en disco (filestore) de los PDF de etiquetas QR, con expulsión LRU por tamaño
+class QrLabelCache(object):
+
+    hits = 0
+    misses = 0
+    _lock = threading.Lock()
+
+    def __init__(self, env):
+        self.path = os.path.join(config.filestore(env.cr.dbname), 'qr_labels')
+        max_mb = env['ir.config_parameter'].sudo().get_param(
+            'custom_certifica_portal.qr_label_cache_max_mb', DEFAULT_MAX_MB)
+        self.max_bytes = int(max_mb) * 1024 * 1024
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(repr((CACHE_VERSION,) + parts).encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pdf')
+
+    def contiene(self, key):
+        return os.path.exists(self._file(key))
+
+    def get(self, key):
+        fname = self._file(key)
+        try:
+            with open(fname, 'rb') as f:
+                data = f.read()
+            os.utime(fname, None)
+        except OSError:
+            data = None
+        with self._lock:
+            if data is None:
+                QrLabelCache.misses += 1
+            else:
+                QrLabelCache.hits += 1
+            _logger.info('Caché etiquetas QR: %s %s (aciertos=%s, fallos=%s)',
+                         'acierto' if data is not None else 'fallo', key,
+                         QrLabelCache.hits, QrLabelCache.misses)
+        return data
+
+    def set(self, key, data):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._file(key))
+        except OSError:
+            _logger.warning('No se pudo guardar la etiqueta QR %s en caché', key, exc_info=True)
+            return
+        self._evict()
+
+    # Marcas de renderizado en curso, visibles para todos los workers del servidor. Guardan los datos
+    # del trabajo para que otro worker pueda volver a encolarlo si el que lo tenía se reinició.
+    def _marca(self, key):
+        return os.path.join(self.path, key + '.pendiente')
+
+    def marcar_pendiente(self, key, datos=None):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self._marca(key), 'w') as f:
+                json.dump(datos or {}, f, default=str)
+        except OSError:
+            _logger.warning('No se pudo marcar la etiqueta QR %s como pendiente', key, exc_info=True)
+
+    def renovar_pendiente(self, key):
+        try:
+            os.utime(self._marca(key), None)
+        except OSError:
+            pass
+
+    def pendiente(self, key, max_age):
+        try:
+            return time.time() - os.stat(self._marca(key)).st_mtime < max_age
+        except OSError:
+            return False
+
+    def datos_pendiente(self, key):
+        try:
+            with open(self._marca(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def quitar_pendiente(self, key):
+        try:
+            os.unlink(self._marca(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.path):
+                if not entry.name.endswith('.pdf'):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            # Se eliminan primero las menos usadas recientemente
+            for mtime, size, fname in sorted(entries):
+                try:
+                    os.unlink(fname)
+                except OSError:
+                    continue
+                total -= size
+                if total <= self.max_bytes:
+                    break
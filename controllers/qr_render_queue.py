@@ -0,0 +1,190 @@
+from logging import getLogger
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import odoo
+import threading
+import time
+
+_logger = getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_QUEUE = 100
+# Primera clave de los bloqueos consultivos de PostgreSQL que hacen de semáforo entre workers;
+# la segunda es el número de turno (0 .. qr_render_workers - 1)
+LOCK_CLAVE = 7141901
+ESPERA_TURNO = 0.5
+# Trabajos terminados que se conservan para consultar su estado y muestras para las métricas
+MAX_TERMINADOS = 1000
+MAX_MUESTRAS = 200
+
+
+class ColaLlena(Exception):
+    pass
+
+
+class Trabajo(object):
+
+    def __init__(self, key, args):
+        self.key = key
+        # (uid, context, report_name, res_id, docargs), para volver a encolarlo
+        self.args = args
+        self.estado = 'pendiente'
+        self.encolado = time.time()
+        self.inicio = None
+        self.fin = None
+        self.error = None
+        self.evento = threading.Event()
+
+    def espera(self):
+        return (self.inicio or time.time()) - self.encolado
+
+
+# Cola acotada del proceso para renderizar etiquetas QR con wkhtmltopdf fuera de los hilos HTTP.
+# Los trabajos se identifican con la clave de QrLabelCache: dos peticiones del mismo certificado y
+# tamaño comparten un único renderizado y el PDF resultante se lee de la caché en disco, también
+# desde otros workers del servidor.
+# El límite qr_render_workers es de todo el servidor: antes de lanzar wkhtmltopdf cada trabajo toma
+# uno de esos turnos con un bloqueo consultivo de la transacción, que PostgreSQL libera aunque el
+# worker muera.
+class QrRenderQueue(object):
+
+    _lock = threading.Lock()
+    _executor = None
+    _workers = 0
+    _trabajos = {}
+    _terminados = deque()
+    _esperas = deque(maxlen=MAX_MUESTRAS)
+    _renders = deque(maxlen=MAX_MUESTRAS)
+    contadores = {'encolados': 0, 'coalescidos': 0, 'reencolados': 0, 'completados': 0, 'errores': 0, 'rechazados': 0}
+
+    def __init__(self, env):
+        ICP = env['ir.config_parameter'].sudo()
+        self.env = env
+        self.dbname = env.cr.dbname
+        self.workers = max(int(ICP.get_param('custom_certifica_portal.qr_render_workers', DEFAULT_WORKERS)), 1)
+        self.max_queue = int(ICP.get_param('custom_certifica_portal.qr_render_queue_max', DEFAULT_MAX_QUEUE))
+
+    def _pool(self):
+        # Se recrea si cambió el límite de concurrencia; los trabajos en curso terminan en el anterior
+        if QrRenderQueue._executor is None or QrRenderQueue._workers != self.workers:
+            if QrRenderQueue._executor is not None:
+                QrRenderQueue._executor.shutdown(wait=False)
+            QrRenderQueue._executor = ThreadPoolExecutor(max_workers=self.workers)
+            QrRenderQueue._workers = self.workers
+        return QrRenderQueue._executor
+
+    def trabajo(self, key):
+        with self._lock:
+            return self._trabajos.get(key)
+
+    def encolar(self, cache, key, uid, context, report_name, res_id, docargs):
+        with self._lock:
+            trabajo = self._trabajos.get(key)
+            if trabajo and trabajo.estado in ('pendiente', 'renderizando'):
+                QrRenderQueue.contadores['coalescidos'] += 1
+                return trabajo
+            if self.max_queue and self._profundidad() >= self.max_queue:
+                QrRenderQueue.contadores['rechazados'] += 1
+                raise ColaLlena()
+            trabajo = Trabajo(key, (uid, context, report_name, res_id, docargs))
+            self._trabajos[key] = trabajo
+            QrRenderQueue.contadores['encolados'] += 1
+            cache.marcar_pendiente(key, {'uid': uid, 'context': context, 'report_name': report_name,
+                                         'res_id': res_id, 'docargs': docargs})
+            self._pool().submit(self._renderizar, trabajo, cache, self.dbname, uid, context, report_name, res_id, docargs)
+        return trabajo
+
+    def reanudar(self, cache, key):
+        # Vuelve a encolar un trabajo sin PDF: expulsado de la caché después de renderizarse, o
+        # abandonado por un worker que se reinició (su marca de pendiente dejó de renovarse).
+        # None si no quedan datos del trabajo.
+        trabajo = self.trabajo(key)
+        if trabajo and trabajo.estado in ('pendiente', 'renderizando'):
+            return trabajo
+        if trabajo:
+            args = trabajo.args
+        else:
+            datos = cache.datos_pendiente(key)
+            if not datos or 'res_id' not in datos:
+                cache.quitar_pendiente(key)
+                return None
+            args = (datos['uid'], datos['context'], datos['report_name'], datos['res_id'], datos['docargs'])
+        _logger.info('Etiqueta QR %s sin PDF ni renderizado en curso; se vuelve a encolar', key)
+        with self._lock:
+            QrRenderQueue.contadores['reencolados'] += 1
+        return self.encolar(cache, key, *args)
+
+    def _esperar_turno(self, cr, cache, key):
+        # Semáforo de todo el servidor; mientras espera renueva la marca para que no parezca abandonado
+        while True:
+            for turno in range(self.workers):
+                cr.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", (LOCK_CLAVE, turno))
+                if cr.fetchone()[0]:
+                    return
+            cache.renovar_pendiente(key)
+            time.sleep(ESPERA_TURNO)
+
+    def _renderizar(self, trabajo, cache, dbname, uid, context, report_name, res_id, docargs):
+        try:
+            with odoo.api.Environment.manage(), odoo.registry(dbname).cursor() as cr:
+                self._esperar_turno(cr, cache, trabajo.key)
+                trabajo.inicio = time.time()
+                trabajo.estado = 'renderizando'
+                cache.renovar_pendiente(trabajo.key)
+                env = odoo.api.Environment(cr, uid, context)
+                data = env.ref(report_name).sudo().render_qweb_pdf([res_id], docargs)[0]
+            cache.set(trabajo.key, data)
+            trabajo.estado = 'listo'
+        except Exception as e:
+            _logger.exception('Error al renderizar la etiqueta QR %s', trabajo.key)
+            trabajo.estado = 'error'
+            trabajo.error = str(e)
+        finally:
+            cache.quitar_pendiente(trabajo.key)
+            trabajo.fin = time.time()
+            trabajo.inicio = trabajo.inicio or trabajo.fin
+            trabajo.evento.set()
+            self._terminar(trabajo)
+
+    def _terminar(self, trabajo):
+        with self._lock:
+            QrRenderQueue.contadores['completados' if trabajo.estado == 'listo' else 'errores'] += 1
+            self._esperas.append(trabajo.inicio - trabajo.encolado)
+            self._renders.append(trabajo.fin - trabajo.inicio)
+            self._terminados.append(trabajo.key)
+            while len(self._terminados) > MAX_TERMINADOS:
+                key = self._terminados.popleft()
+                if self._trabajos.get(key) and self._trabajos[key].evento.is_set():
+                    del self._trabajos[key]
+            _logger.info('cola_qr job=%s estado=%s espera_ms=%.1f render_ms=%.1f profundidad=%s',
+                         trabajo.key, trabajo.estado, (trabajo.inicio - trabajo.encolado) * 1000,
+                         (trabajo.fin - trabajo.inicio) * 1000, self._profundidad())
+
+    def _profundidad(self):
+        return sum(1 for trabajo in self._trabajos.values() if trabajo.estado == 'pendiente')
+
+    def metricas(self):
+        # Contadores y tiempos de este proceso; renderizando_servidor cuenta los turnos tomados en todos
+        self.env.cr.execute("""
+            SELECT count(*) FROM pg_locks
+             WHERE locktype = 'advisory' AND classid = %s AND objsubid = 2 AND granted
+        """, (LOCK_CLAVE,))
+        renderizando_servidor = self.env.cr.fetchone()[0]
+        with self._lock:
+            esperas = list(self._esperas)
+            renders = list(self._renders)
+            pendientes = [trabajo for trabajo in self._trabajos.values() if trabajo.estado == 'pendiente']
+            metricas = dict(QrRenderQueue.contadores)
+            metricas.update({
+                'limite_concurrencia': self.workers,
+                'renderizando_servidor': renderizando_servidor,
+                'limite_cola': self.max_queue,
+                'profundidad': len(pendientes),
+                'renderizando': sum(1 for trabajo in self._trabajos.values() if trabajo.estado == 'renderizando'),
+                'espera_actual_max_ms': round(max([trabajo.espera() for trabajo in pendientes] or [0]) * 1000, 1),
+                'espera_media_ms': round(sum(esperas) / len(esperas) * 1000, 1) if esperas else 0,
+                'espera_max_ms': round(max(esperas) * 1000, 1) if esperas else 0,
+                'render_medio_ms': round(sum(renders) / len(renders) * 1000, 1) if renders else 0,
+            })
+        return metricas
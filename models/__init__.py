@@ -0,0 +1,7 @@
+from . import certifica_portal_api_token
+from . import certifica_portal_busqueda
+from . import certifica_portal_ultimo_certificado
+from . import certifica_portal_vencimiento
+from . import informes_encuestas_merge
+from . import informes_encuestas_tipo_encuesta_portal
+from . import qr_images
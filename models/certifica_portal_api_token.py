@@ -0,0 +1,56 @@
+from logging import getLogger
+
+from odoo import api, fields, models, tools
+import secrets
+
+_logger = getLogger(__name__)
+
+
+class CertificaPortalApiToken(models.Model):
+    _name = 'certifica.portal.api.token'
+    _description = 'Token de la API del portal de certificados'
+
+    name = fields.Char('Descripción', required=True)
+    partner_id = fields.Many2one('res.partner', 'Cliente', required=True, ondelete='cascade',
+                                 domain=[('is_company', '=', True)])
+    token = fields.Char(required=True, copy=False, index=True, groups='base.group_system',
+                        default=lambda self: secrets.token_urlsafe(32))
+    active = fields.Boolean(default=True)
+
+    _sql_constraints = [
+        ('token_uniq', 'unique(token)', 'El token debe ser único.'),
+    ]
+
+    def action_regenerar_token(self):
+        for record in self:
+            record.token = secrets.token_urlsafe(32)
+        self.clear_caches()
+
+    @api.model
+    def _cliente_por_token(self, token):
+        # Un token desconocido no agrega entradas a la caché
+        if not token:
+            return False
+        return self._tokens_activos().get(token, False)
+
+    @api.model
+    @tools.ormcache()
+    def _tokens_activos(self):
+        # {token: partner_id} de los tokens activos
+        return {record.token: record.partner_id.id for record in self.sudo().search([])}
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super(CertificaPortalApiToken, self).create(vals_list)
+        self.clear_caches()
+        return records
+
+    def write(self, vals):
+        res = super(CertificaPortalApiToken, self).write(vals)
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super(CertificaPortalApiToken, self).unlink()
+        self.clear_caches()
+        return res
@@ -0,0 +1,128 @@
+from logging import getLogger
+
+from odoo import api, models, tools
+import time
+
+_logger = getLogger(__name__)
+
+# Columnas de texto indexadas con trigramas para las búsquedas del portal
+CAMPOS_BUSQUEDA = {
+    'informes.encuestas.maquinarias': ['name', 'modelo', 'sku', 'kit', 'observacion'],
+    'res.partner': ['name', 'vat'],
+}
+# Columnas usadas para ordenar por relevancia según el modo de búsqueda (searchbar_inputs);
+# 'many2one.campo' compara con el campo del registro relacionado
+CAMPOS_RELEVANCIA = {
+    'informes.encuestas.maquinarias': {
+        'serie': ['name'],
+        'marca': ['marca_id.name'],
+        'all': ['name', 'modelo', 'sku', 'kit', 'observacion', 'equipotipo_id.name', 'marca_id.name'],
+    },
+    'res.partner': {
+        'vat': ['vat'],
+        'name': ['name'],
+        'all': ['name', 'vat'],
+    },
+}
+
+
+class CertificaPortalBusqueda(models.AbstractModel):
+    _name = 'certifica.portal.busqueda'
+    _description = 'Búsqueda del portal de certificados'
+
+    def init(self):
+        if not self._trigramas_disponibles():
+            _logger.warning('No se pudo activar pg_trgm; las búsquedas del portal no usarán índices de trigramas')
+            return
+        tablas = dict(CAMPOS_BUSQUEDA)
+        # Nombres de los many2one que también se buscan con ilike
+        Maquinarias = self.env['informes.encuestas.maquinarias']
+        for campo in ('equipotipo_id', 'marca_id'):
+            tablas[Maquinarias._fields[campo].comodel_name] = ['name']
+        for model_name, campos in tablas.items():
+            Model = self.env[model_name]
+            for campo in campos:
+                field = Model._fields.get(campo)
+                if not field or not field.store or field.translate:
+                    continue
+                indexname = '%s_%s_trgm_index' % (Model._table, campo)
+                if not tools.index_exists(self._cr, indexname):
+                    self._cr.execute('CREATE INDEX "%s" ON "%s" USING gin ("%s" gin_trgm_ops)' % (
+                        indexname, Model._table, campo))
+
+    def _trigramas_disponibles(self):
+        self._cr.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if self._cr.fetchone():
+            return True
+        try:
+            with self._cr.savepoint():
+                self._cr.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        except Exception:
+            return False
+        self.clear_caches()
+        return True
+
+    @api.model
+    @tools.ormcache()
+    def _trigramas_activos(self):
+        self._cr.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        return bool(self._cr.fetchone())
+
+    @api.model
+    def _relevancia(self, model_name, search_in, search):
+        # Expresión SQL (y parámetros) para ordenar los resultados por similitud con el término
+        if not search or not self._trigramas_activos():
+            return None
+        modos = CAMPOS_RELEVANCIA.get(model_name, {})
+        campos = modos.get(search_in, modos.get('all', []))
+        if not campos:
+            return None
+        Model = self.env[model_name]
+        expresiones = []
+        for campo in campos:
+            columna = '"%s"."%s"' % (Model._table, campo)
+            if '.' in campo:
+                relacion, campo_relacionado = campo.split('.')
+                columna = '(SELECT "%s" FROM "%s" WHERE id = "%s"."%s")' % (
+                    campo_relacionado, self.env[Model._fields[relacion].comodel_name]._table, Model._table, relacion)
+            expresiones.append("word_similarity(%%s, COALESCE(%s, ''))" % columna)
+        sql = expresiones[0] if len(expresiones) == 1 else 'GREATEST(%s)' % ', '.join(expresiones)
+        return sql, [search] * len(campos)
+
+    @api.model
+    def _benchmark_busqueda(self, tamanos=(10000, 100000, 1000000), termino='a1b2c'):
+        # Compara ilike '%termino%' sin y con índice de trigramas sobre tablas temporales.
+        # Uso: env['certifica.portal.busqueda']._benchmark_busqueda() desde odoo shell
+        if not self._trigramas_activos():
+            _logger.warning('pg_trgm no está disponible; no se puede ejecutar el benchmark')
+            return []
+        resultados = []
+        cr = self._cr
+        for tamano in tamanos:
+            with cr.savepoint():
+                cr.execute("""
+                    CREATE TEMP TABLE certifica_bench_busqueda ON COMMIT DROP AS
+                    SELECT i AS id, md5(i::text) AS name, md5((i * 7)::text) AS modelo,
+                           md5((i * 13)::text) AS sku
+                      FROM generate_series(1, %s) AS i
+                """, (tamano,))
+                cr.execute("ANALYZE certifica_bench_busqueda")
+                query = """
+                    SELECT count(*) FROM certifica_bench_busqueda
+                     WHERE name ILIKE %(t)s OR modelo ILIKE %(t)s OR sku ILIKE %(t)s
+                """
+                params = {'t': '%%%s%%' % termino}
+                inicio = time.time()
+                cr.execute(query, params)
+                tiempo_ilike = time.time() - inicio
+                for campo in ('name', 'modelo', 'sku'):
+                    cr.execute('CREATE INDEX ON certifica_bench_busqueda USING gin (%s gin_trgm_ops)' % campo)
+                cr.execute("ANALYZE certifica_bench_busqueda")
+                inicio = time.time()
+                cr.execute(query, params)
+                tiempo_trgm = time.time() - inicio
+                cr.execute("DROP TABLE certifica_bench_busqueda")
+            resultados.append((tamano, tiempo_ilike, tiempo_trgm))
+            _logger.info('Benchmark búsqueda portal: %s filas, ilike %.1f ms, trigramas %.1f ms',
+                         tamano, tiempo_ilike * 1000, tiempo_trgm * 1000)
+        return resultados
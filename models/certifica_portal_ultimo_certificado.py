@@ -0,0 +1,238 @@
+from logging import getLogger
+
+from odoo import api, fields, models, tools
+from collections import Counter, defaultdict
+
+_logger = getLogger(__name__)
+
+# Campos del certificado que determinan cuál es el último de cada equipo/persona
+# (sedecliente no cambia el último certificado, pero se copia al índice para el resumen de vencimientos)
+CAMPOS_ULTIMO_CERTIFICADO = {'cliente_id', 'xtipodocumento', 'xmaquinaria', 'personas_id', 'fecha_vigencia', 'active', 'sedecliente'}
+
+
+class CertificaPortalUltimoCertificado(models.Model):
+    _name = 'certifica.portal.ultimo.certificado'
+    _description = 'Último certificado por equipo/persona'
+    _log_access = False
+
+    cliente_id = fields.Many2one('res.partner', required=True, index=True, ondelete='cascade')
+    xtipodocumento = fields.Many2one('informes.encuestas.tipo.encuesta.portal', required=True, ondelete='cascade')
+    xmaquinaria = fields.Many2one('informes.encuestas.maquinarias', ondelete='cascade')
+    personas_id = fields.Many2one('res.partner', ondelete='cascade')
+    certificado_id = fields.Many2one('informes.encuestas.merge', required=True, ondelete='cascade')
+    fecha_vigencia = fields.Date()
+    sedecliente = fields.Char()
+    fecha_actualizacion = fields.Datetime(help='Momento en que cambió el último certificado (sincronización incremental)')
+
+    def init(self):
+        cr = self._cr
+        if not tools.index_exists(cr, 'certifica_portal_ultimo_certificado_maquinaria_uniq'):
+            cr.execute("""
+                CREATE UNIQUE INDEX certifica_portal_ultimo_certificado_maquinaria_uniq
+                    ON certifica_portal_ultimo_certificado (cliente_id, xtipodocumento, xmaquinaria)
+                 WHERE xmaquinaria IS NOT NULL
+            """)
+        if not tools.index_exists(cr, 'certifica_portal_ultimo_certificado_personas_uniq'):
+            cr.execute("""
+                CREATE UNIQUE INDEX certifica_portal_ultimo_certificado_personas_uniq
+                    ON certifica_portal_ultimo_certificado (cliente_id, xtipodocumento, personas_id)
+                 WHERE personas_id IS NOT NULL
+            """)
+        # Paginación por cursor (id) de la API
+        tools.create_index(cr, 'certifica_portal_ultimo_certificado_cliente_tipo_id_index', self._table,
+                           ['cliente_id', 'xtipodocumento', 'id'])
+        # Índices que respaldan el DISTINCT ON sobre los certificados
+        merge_table = self.env['informes.encuestas.merge']._table
+        tools.create_index(cr, 'informes_encuestas_merge_ultimo_maquinaria_index', merge_table,
+                           ['cliente_id', 'xtipodocumento', 'xmaquinaria', 'fecha_vigencia DESC', 'id DESC'])
+        tools.create_index(cr, 'informes_encuestas_merge_ultimo_personas_index', merge_table,
+                           ['cliente_id', 'xtipodocumento', 'personas_id', 'fecha_vigencia DESC', 'id DESC'])
+        # Columna sedecliente agregada después de creado el índice
+        cr.execute("""
+            UPDATE {tabla} u SET sedecliente = m.sedecliente
+              FROM {merge} m
+             WHERE m.id = u.certificado_id AND u.sedecliente IS NULL AND m.sedecliente IS NOT NULL
+        """.format(tabla=self._table, merge=merge_table))
+
+    @api.model
+    def _buscar(self, cliente_id, tipo_id, asset_id, personas=False):
+        campo = 'personas_id' if personas else 'xmaquinaria'
+        return self.sudo().search([
+            ('cliente_id', '=', cliente_id),
+            ('xtipodocumento', '=', tipo_id),
+            (campo, '=', asset_id),
+        ], limit=1).certificado_id
+
+    @api.model
+    def _portal_consulta(self, model_name, campo, cliente_id, tipo_id, domain, order, relevancia=None):
+        # Partes SQL (from, where, order) del listado del portal: registros de model_name que
+        # cumplen el dominio y tienen certificados del cliente/tipo
+        Model = self.env[model_name].sudo()
+        Model._flush_search(domain, order=order)
+        self.flush()
+        query = Model._where_calc(domain)
+        Model._apply_ir_rules(query, 'read')
+        query.where_clause.append('"{tabla}"."id" IN (SELECT "{campo}" FROM "{indice}" WHERE cliente_id = %s AND xtipodocumento = %s)'.format(
+            tabla=Model._table, campo=campo, indice=self._table))
+        query.where_clause_params += [cliente_id, tipo_id]
+        order_by = Model._generate_order_by(order, query)
+        order_params = []
+        if relevancia:
+            # relevancia: (expresión SQL, parámetros) que se ordena antes que el orden indicado
+            order_by = ' ORDER BY %s DESC, %s' % (relevancia[0], order_by.replace(' ORDER BY ', '', 1))
+            order_params = relevancia[1]
+        from_clause, where_clause, where_params = query.get_sql()
+        where_str = where_clause and (" WHERE %s" % where_clause) or ''
+        return from_clause, where_str, where_params, order_by, order_params
+
+    @api.model
+    def _portal_pagina(self, model_name, campo, cliente_id, tipo_id, domain, order, limit, offset, relevancia=None):
+        # Ids de la página y total de registros de model_name con certificados del cliente/tipo.
+        # El total sale de la misma consulta (count(*) OVER ()); solo si la página está vacía
+        # hace falta contar aparte.
+        from_clause, where_str, where_params, order_by, order_params = self._portal_consulta(
+            model_name, campo, cliente_id, tipo_id, domain, order, relevancia=relevancia)
+        self._cr.execute('SELECT "{tabla}".id, count(*) OVER () FROM {from_clause}{where}{order_by} LIMIT %s OFFSET %s'.format(
+            tabla=self.env[model_name]._table, from_clause=from_clause, where=where_str, order_by=order_by),
+            where_params + order_params + [limit, offset])
+        rows = self._cr.fetchall()
+        if rows:
+            return [row[0] for row in rows], rows[0][1]
+        if not offset:
+            return [], 0
+        self._cr.execute('SELECT count(1) FROM {from_clause}{where}'.format(from_clause=from_clause, where=where_str), where_params)
+        return [], self._cr.fetchone()[0]
+
+    @api.model
+    def _portal_exportacion(self, model_name, campo, cliente_id, tipo_id, domain, order, relevancia=None):
+        # Consulta (sql, params) con todos los ids del listado, en el orden de la página y con su
+        # último certificado, para recorrerla con un cursor de servidor
+        from_clause, where_str, where_params, order_by, order_params = self._portal_consulta(
+            model_name, campo, cliente_id, tipo_id, domain, order, relevancia=relevancia)
+        sql = """
+            SELECT "{tabla}".id,
+                   (SELECT u.certificado_id FROM "{indice}" u
+                     WHERE u.cliente_id = %s AND u.xtipodocumento = %s AND u."{campo}" = "{tabla}".id)
+              FROM {from_clause}{where}{order_by}
+        """.format(tabla=self.env[model_name]._table, indice=self._table, campo=campo,
+                   from_clause=from_clause, where=where_str, order_by=order_by)
+        return sql, [cliente_id, tipo_id] + where_params + order_params
+
+    @api.model
+    def _api_pagina(self, cliente_id, tipo_id, personas, cursor, limit, updated_since=None):
+        # Paginación por cursor: filas con id > cursor en orden de id. Con updated_since solo las
+        # que cambiaron de último certificado o cuyo certificado (código, fechas, PDF) o
+        # equipo/persona se modificó desde entonces.
+        campo = 'personas_id' if personas else 'xmaquinaria'
+        Activo = self.env['res.partner' if personas else 'informes.encuestas.maquinarias']
+        self.flush()
+        Activo.flush(['write_date'])
+        Merge = self.env['informes.encuestas.merge']
+        Merge.flush(['write_date'])
+        query = """
+            SELECT u.id FROM {tabla} u
+              JOIN {activos} a ON a.id = u.{campo}
+              JOIN {merge} m ON m.id = u.certificado_id
+             WHERE u.cliente_id = %s AND u.xtipodocumento = %s AND u.id > %s
+        """.format(tabla=self._table, activos=Activo._table, merge=Merge._table, campo=campo)
+        params = [cliente_id, tipo_id, cursor or 0]
+        if updated_since:
+            query += " AND (u.fecha_actualizacion >= %s OR a.write_date >= %s OR m.write_date >= %s)"
+            params += [updated_since, updated_since, updated_since]
+        query += " ORDER BY u.id LIMIT %s"
+        params.append(limit)
+        self._cr.execute(query, params)
+        return self.browse([row[0] for row in self._cr.fetchall()])
+
+    @api.model
+    def _actualizar(self, claves):
+        # claves: iterable de (cliente_id, xtipodocumento, xmaquinaria, personas_id)
+        grupos = defaultdict(lambda: {'xmaquinaria': set(), 'personas_id': set()})
+        for cliente_id, tipo_id, maquinaria_id, persona_id in claves:
+            if not cliente_id or not tipo_id:
+                continue
+            if maquinaria_id:
+                grupos[(cliente_id, tipo_id)]['xmaquinaria'].add(maquinaria_id)
+            if persona_id:
+                grupos[(cliente_id, tipo_id)]['personas_id'].add(persona_id)
+        if not grupos:
+            return
+        # El resumen de vencimientos se corrige con la diferencia entre los tramos de estas claves
+        # antes y después, sin volver a agregar todo el cliente/tipo
+        antes = self._conteo_tramos(grupos)
+        for (cliente_id, tipo_id), campos in grupos.items():
+            for campo, ids in campos.items():
+                if ids:
+                    self._recalcular(campo, "cliente_id = %s AND xtipodocumento = %s AND {campo} = ANY(%s)",
+                                     [cliente_id, tipo_id, list(ids)])
+        self.invalidate_cache()
+        despues = self._conteo_tramos(grupos)
+        self.env['certifica.portal.vencimiento']._aplicar_deltas({
+            clave: despues[clave] - antes[clave] for clave in set(antes) | set(despues)
+            if despues[clave] != antes[clave]})
+
+    def _conteo_tramos(self, grupos):
+        # Counter {(cliente_id, xtipodocumento, sedecliente, tramo): filas} de las claves del índice
+        tramo_sql, tramo_params = self.env['certifica.portal.vencimiento']._tramo_sql('fecha_vigencia')
+        conteo = Counter()
+        for (cliente_id, tipo_id), campos in grupos.items():
+            for campo, ids in campos.items():
+                if not ids:
+                    continue
+                self._cr.execute("""
+                    SELECT coalesce(sedecliente, ''), {tramo}, count(*)
+                      FROM {tabla}
+                     WHERE cliente_id = %s AND xtipodocumento = %s AND {campo} = ANY(%s)
+                           AND fecha_vigencia IS NOT NULL
+                  GROUP BY 1, 2
+                """.format(tabla=self._table, campo=campo, tramo=tramo_sql),
+                    tramo_params + [cliente_id, tipo_id, list(ids)])
+                for sedecliente, tramo, cantidad in self._cr.fetchall():
+                    if tramo:
+                        conteo[(cliente_id, tipo_id, sedecliente, tramo)] += cantidad
+        return conteo
+
+    @api.model
+    def _reconstruir(self):
+        _logger.info('Reconstruyendo el índice de últimos certificados')
+        for campo in ('xmaquinaria', 'personas_id'):
+            self._recalcular(campo, "TRUE", [])
+        self.invalidate_cache()
+        self.env['certifica.portal.vencimiento']._reconstruir()
+        self._cr.execute("SELECT count(*) FROM %s" % self._table)
+        _logger.info('Índice de últimos certificados reconstruido: %s filas', self._cr.fetchone()[0])
+
+    def _recalcular(self, campo, condicion, params):
+        # Recalcula las filas que cumplen la condición. Las filas cuyo certificado no cambia
+        # conservan fecha_actualizacion; las claves que ya no tienen certificados se eliminan.
+        Merge = self.env['informes.encuestas.merge']
+        Merge.flush(list(CAMPOS_ULTIMO_CERTIFICADO.intersection(Merge._fields)))
+        condicion = condicion.format(campo=campo)
+        activo = " AND active" if 'active' in Merge._fields else ""
+        self._cr.execute("""
+            WITH nuevos AS (
+                SELECT DISTINCT ON (cliente_id, xtipodocumento, {campo})
+                       cliente_id, xtipodocumento, {campo}, id AS certificado_id, fecha_vigencia, sedecliente
+                  FROM {merge}
+                 WHERE {campo} IS NOT NULL AND cliente_id IS NOT NULL AND xtipodocumento IS NOT NULL
+                       AND {condicion}{activo}
+              ORDER BY cliente_id, xtipodocumento, {campo}, fecha_vigencia DESC, id DESC
+            ), guardados AS (
+                INSERT INTO {tabla} AS u (cliente_id, xtipodocumento, {campo}, certificado_id, fecha_vigencia, sedecliente, fecha_actualizacion)
+                SELECT cliente_id, xtipodocumento, {campo}, certificado_id, fecha_vigencia, sedecliente, now() at time zone 'UTC'
+                  FROM nuevos
+                    ON CONFLICT (cliente_id, xtipodocumento, {campo}) WHERE {campo} IS NOT NULL
+                    DO UPDATE SET certificado_id = EXCLUDED.certificado_id,
+                                  fecha_vigencia = EXCLUDED.fecha_vigencia,
+                                  sedecliente = EXCLUDED.sedecliente,
+                                  fecha_actualizacion = CASE
+                                      WHEN u.certificado_id = EXCLUDED.certificado_id
+                                           AND u.fecha_vigencia IS NOT DISTINCT FROM EXCLUDED.fecha_vigencia
+                                      THEN u.fecha_actualizacion
+                                      ELSE EXCLUDED.fecha_actualizacion END
+                RETURNING u.id
+            )
+            DELETE FROM {tabla}
+             WHERE {campo} IS NOT NULL AND {condicion}
+                   AND id NOT IN (SELECT id FROM guardados)
+        """.format(tabla=self._table, campo=campo, merge=Merge._table, condicion=condicion, activo=activo), params + params)
@@ -0,0 +1,166 @@
+from logging import getLogger
+
+from odoo import api, fields, models, tools
+from datetime import timedelta
+
+_logger = getLogger(__name__)
+
+# Tramos de vencimiento del último certificado: (código, etiqueta, días desde, días hasta)
+TRAMOS_VENCIMIENTO = [
+    ('vencido', 'Vencidos', None, -1),
+    ('30', 'Próximos 30 días', 0, 30),
+    ('60', 'De 31 a 60 días', 31, 60),
+    ('90', 'De 61 a 90 días', 61, 90),
+]
+# Valor del filtro sedecliente del portal para los certificados sin sede
+SIN_SEDE = '-'
+
+
+class CertificaPortalVencimiento(models.Model):
+    _name = 'certifica.portal.vencimiento'
+    _description = 'Resumen de vencimientos por cliente, tipo y sede'
+    _log_access = False
+
+    cliente_id = fields.Many2one('res.partner', required=True, ondelete='cascade')
+    xtipodocumento = fields.Many2one('informes.encuestas.tipo.encuesta.portal', required=True, ondelete='cascade')
+    sedecliente = fields.Char(help='Vacío (no NULL) para los certificados sin sede')
+    tramo = fields.Selection([(tramo[0], tramo[1]) for tramo in TRAMOS_VENCIMIENTO], required=True)
+    cantidad = fields.Integer()
+    fecha_calculo = fields.Date(help='Día respecto al cual se calcularon los tramos')
+
+    def init(self):
+        tools.create_index(self._cr, 'certifica_portal_vencimiento_cliente_tipo_index', self._table,
+                           ['cliente_id', 'xtipodocumento'])
+        # Clave de las filas que actualiza _aplicar_deltas
+        if not tools.index_exists(self._cr, 'certifica_portal_vencimiento_uniq'):
+            self._cr.execute("""
+                CREATE UNIQUE INDEX certifica_portal_vencimiento_uniq
+                    ON certifica_portal_vencimiento (cliente_id, xtipodocumento, sedecliente, tramo)
+            """)
+
+    @api.model
+    def _rango_tramo(self, tramo, hoy=None):
+        # (desde, hasta) de fecha_vigencia del tramo; None si no tiene límite
+        hoy = hoy or fields.Date.today()
+        for codigo, etiqueta, desde, hasta in TRAMOS_VENCIMIENTO:
+            if codigo == tramo:
+                return (desde is not None and hoy + timedelta(days=desde) or None,
+                        hoy + timedelta(days=hasta))
+        return None
+
+    @api.model
+    def _tramo_sql(self, columna, hoy=None):
+        # (expresión SQL, parámetros) con el código de tramo de la fecha de vigencia en columna, o NULL
+        hoy = hoy or fields.Date.today()
+        tramos = []
+        params = []
+        for codigo, etiqueta, desde, hasta in TRAMOS_VENCIMIENTO:
+            if desde is None:
+                tramos.append("WHEN {columna} <= %s THEN %s".format(columna=columna))
+                params += [hoy + timedelta(days=hasta), codigo]
+            else:
+                tramos.append("WHEN {columna} BETWEEN %s AND %s THEN %s".format(columna=columna))
+                params += [hoy + timedelta(days=desde), hoy + timedelta(days=hasta), codigo]
+        return "CASE %s END" % ' '.join(tramos), params
+
+    @api.model
+    def _resumen(self, cliente_id, tipo_id):
+        # {sedecliente: {tramo: cantidad}} del cliente/tipo; si el cron diario no corrió, se recalcula
+        hoy = fields.Date.today()
+        filas = self.sudo().search([('cliente_id', '=', cliente_id), ('xtipodocumento', '=', tipo_id)])
+        if any(fila.fecha_calculo != hoy for fila in filas):
+            self.sudo()._recalcular([(cliente_id, tipo_id)])
+            filas = self.sudo().search([('cliente_id', '=', cliente_id), ('xtipodocumento', '=', tipo_id)])
+        resumen = {}
+        for fila in filas:
+            resumen.setdefault(fila.sedecliente or '', {})[fila.tramo] = fila.cantidad
+        return resumen
+
+    @api.model
+    def _recalcular(self, grupos=None):
+        # grupos: iterable de (cliente_id, xtipodocumento); None recalcula todo. Se agrega sobre el
+        # índice de últimos certificados, no sobre todos los certificados.
+        UltimoCertificado = self.env['certifica.portal.ultimo.certificado']
+        UltimoCertificado.flush()
+        hoy = fields.Date.today()
+        tramo_sql, params = self._tramo_sql('u.fecha_vigencia', hoy)
+        condicion = "TRUE"
+        condicion_params = []
+        if grupos is not None:
+            grupos = list(set(grupos))
+            if not grupos:
+                return
+            condicion = "({alias}cliente_id, {alias}xtipodocumento) IN %s"
+            condicion_params = [tuple(grupos)]
+        # Dos cargas del tablero pueden recalcular el mismo grupo a la vez: el DELETE de una no ve las
+        # filas recién confirmadas por la otra, por eso el INSERT actualiza en conflicto
+        self._cr.execute("DELETE FROM {tabla} WHERE {condicion}".format(
+            tabla=self._table, condicion=condicion.format(alias='')), condicion_params)
+        self._cr.execute("""
+            INSERT INTO {tabla} (cliente_id, xtipodocumento, sedecliente, tramo, cantidad, fecha_calculo)
+            SELECT cliente_id, xtipodocumento, sedecliente, tramo, count(*), %s
+              FROM (SELECT u.cliente_id, u.xtipodocumento, coalesce(u.sedecliente, '') AS sedecliente,
+                           {tramo} AS tramo
+                      FROM {indice} u
+                     WHERE u.fecha_vigencia IS NOT NULL AND {condicion_u}) t
+             WHERE tramo IS NOT NULL
+          GROUP BY cliente_id, xtipodocumento, sedecliente, tramo
+                ON CONFLICT (cliente_id, xtipodocumento, sedecliente, tramo)
+                DO UPDATE SET cantidad = EXCLUDED.cantidad, fecha_calculo = EXCLUDED.fecha_calculo
+        """.format(tabla=self._table, indice=UltimoCertificado._table,
+                   tramo=tramo_sql, condicion_u=condicion.format(alias='u.')),
+            [hoy] + params + condicion_params)
+        self.invalidate_cache()
+
+    @api.model
+    def _aplicar_deltas(self, deltas):
+        # deltas: {(cliente_id, xtipodocumento, sedecliente, tramo): +/-n} de los certificados que
+        # cambiaron. Los grupos calculados otro día se dejan para el recálculo completo de _resumen.
+        if not deltas:
+            return
+        hoy = fields.Date.today()
+        grupos = tuple(set((cliente_id, tipo_id) for cliente_id, tipo_id, sedecliente, tramo in deltas))
+        self._cr.execute("""
+            SELECT DISTINCT cliente_id, xtipodocumento FROM {tabla}
+             WHERE (cliente_id, xtipodocumento) IN %s AND fecha_calculo IS DISTINCT FROM %s
+        """.format(tabla=self._table), [grupos, hoy])
+        desactualizados = set(self._cr.fetchall())
+        for (cliente_id, tipo_id, sedecliente, tramo), delta in deltas.items():
+            if (cliente_id, tipo_id) in desactualizados:
+                continue
+            self._cr.execute("""
+                INSERT INTO {tabla} AS v (cliente_id, xtipodocumento, sedecliente, tramo, cantidad, fecha_calculo)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (cliente_id, xtipodocumento, sedecliente, tramo)
+                    DO UPDATE SET cantidad = v.cantidad + EXCLUDED.cantidad
+            """.format(tabla=self._table), [cliente_id, tipo_id, sedecliente, tramo, delta, hoy])
+        self._cr.execute("DELETE FROM {tabla} WHERE (cliente_id, xtipodocumento) IN %s AND cantidad <= 0".format(
+            tabla=self._table), [grupos])
+        self.invalidate_cache()
+
+    @api.model
+    def _reconstruir(self):
+        # Cron diario: los tramos dependen del día, así que se recalcula todo
+        self._recalcular()
+        self._cr.execute("SELECT count(*) FROM %s" % self._table)
+        _logger.info('Resumen de vencimientos recalculado: %s filas', self._cr.fetchone()[0])
+
+    @api.model
+    def _portal_activos(self, cliente_id, tipo_id, tramo, sedecliente=None, limit=None, offset=0):
+        # Filas del índice de últimos certificados cuyo vencimiento cae en el tramo; sedecliente
+        # None para todas las sedes o SIN_SEDE para los certificados sin sede
+        desde, hasta = self._rango_tramo(tramo)
+        domain = [
+            ('cliente_id', '=', cliente_id),
+            ('xtipodocumento', '=', tipo_id),
+            ('fecha_vigencia', '<=', hasta),
+        ]
+        if desde:
+            domain.append(('fecha_vigencia', '>=', desde))
+        if sedecliente == SIN_SEDE:
+            domain += ['|', ('sedecliente', '=', False), ('sedecliente', '=', '')]
+        elif sedecliente:
+            domain.append(('sedecliente', '=', sedecliente))
+        UltimoCertificado = self.env['certifica.portal.ultimo.certificado'].sudo()
+        return (UltimoCertificado.search(domain, order='fecha_vigencia, id', limit=limit, offset=offset),
+                UltimoCertificado.search_count(domain))
@@ -0,0 +1,114 @@
+from logging import getLogger
+
+from odoo import api, fields, models, tools
+from .certifica_portal_ultimo_certificado import CAMPOS_ULTIMO_CERTIFICADO
+from .qr_images import QR_CAMPOS, QR_TAMANOS, generar_qr_lote
+import threading
+
+_logger = getLogger(__name__)
+
+# Campos que determinan la URL codificada en los QR del certificado
+CAMPOS_URL_QR = {'cliente_id', 'xtipodocumento', 'xmaquinaria', 'personas_id'}
+QR_LOTE = 200
+
+
+class InformesEncuestasMerge(models.Model):
+    _inherit = 'informes.encuestas.merge'
+
+    qr_pendiente = fields.Boolean('QR pendiente de generar', default=True, copy=False, index=True)
+
+    def init(self):
+        super(InformesEncuestasMerge, self).init()
+        tools.create_index(self._cr, 'informes_encuestas_merge_cliente_tipo_index',
+                           self._table, ['cliente_id', 'xtipodocumento'])
+
+    @api.model
+    def _portal_conteo_documentos(self, partner_id):
+        # Una sola consulta agrupada por tipo de documento, sobre el índice (cliente_id, xtipodocumento):
+        # {xtipodocumento: (equipos distintos, personas distintas)}.
+        # No se guarda en ormcache: invalidarla en cada alta/edición de certificados vaciaría la
+        # caché de todo el registro en todos los workers.
+        grupos = self.sudo().read_group(
+            [('cliente_id', '=', partner_id)],
+            ['xmaquinaria:count_distinct', 'personas_id:count_distinct'],
+            ['xtipodocumento'], lazy=False)
+        conteos = {}
+        for grupo in grupos:
+            if grupo['xtipodocumento']:
+                conteos[grupo['xtipodocumento'][0]] = (grupo['xmaquinaria'] or 0, grupo['personas_id'] or 0)
+        return conteos
+
+    @api.model
+    def _portal_ultimos_certificados(self, partner_id, tipo_id, personas=False, sedecliente=None):
+        # Último certificado (por fecha_vigencia) de cada equipo/persona del cliente
+        campo = 'personas_id' if personas else 'xmaquinaria'
+        domain = [
+            ('cliente_id', '=', partner_id),
+            ('xtipodocumento', '=', tipo_id),
+            (campo, '!=', False),
+        ]
+        if sedecliente:
+            domain.append(('certificado_id.sedecliente', '=', sedecliente))
+        return self.env['certifica.portal.ultimo.certificado'].sudo().search(domain, order=campo).mapped('certificado_id')
+
+    def _claves_ultimo_certificado(self):
+        return [(r.cliente_id.id, r.xtipodocumento.id, r.xmaquinaria.id, r.personas_id.id) for r in self]
+
+    def _portal_url_qr(self, urlbase=None):
+        # Misma URL que codifica print_qrcode: el último certificado del equipo o el propio certificado (personas)
+        self.ensure_one()
+        urlbase = urlbase or self.env['ir.config_parameter'].sudo().get_param('web.base.url')
+        if self.xtipodocumento.code=='personas':
+            return str(urlbase)+'/web/certificado_current/download_pdf/'+str(self.id)
+        return str(urlbase)+'/web/ultimocertificado/'+str(self.xtipodocumento.code)+'/'+str(self.xmaquinaria.id)+'/'+str(self.cliente_id.id)
+
+    @api.model
+    def _generar_qr_pendientes(self, limite=None):
+        # Cron: genera los cuatro tamaños de QR de los certificados nuevos o modificados, por lotes.
+        # Se generan en el propio proceso del cron, sin pool de procesos: bifurcar un worker de Odoo
+        # duplica su memoria y sus conexiones; lotes de QR_LOTE y commits acotan cada ejecución.
+        campos = {tamano: campo for tamano, campo in QR_CAMPOS.items()
+                  if campo in self._fields and self._fields[campo].store and not self._fields[campo].compute}
+        if not campos:
+            _logger.warning('informes.encuestas.merge no tiene campos qr_code*; no se generan QR')
+            return
+        urlbase = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
+        procesados = 0
+        while limite is None or procesados < limite:
+            certificados = self.sudo().search([('qr_pendiente', '=', True)], limit=QR_LOTE)
+            if not certificados:
+                break
+            urls = [certificado._portal_url_qr(urlbase) for certificado in certificados]
+            imagenes = {tamano: generar_qr_lote(urls, QR_TAMANOS[tamano][0]) for tamano in campos}
+            for i, certificado in enumerate(certificados):
+                vals = {campo: imagenes[tamano][i] for tamano, campo in campos.items()}
+                vals['qr_pendiente'] = False
+                certificado.write(vals)
+            procesados += len(certificados)
+            _logger.info('QR generados para %s certificados (%s en total)', len(certificados), procesados)
+            if not getattr(threading.current_thread(), 'testing', False):
+                self.env.cr.commit()
+            self.env.clear()
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super(InformesEncuestasMerge, self).create(vals_list)
+        self.env['certifica.portal.ultimo.certificado'].sudo()._actualizar(records._claves_ultimo_certificado())
+        return records
+
+    def write(self, vals):
+        if CAMPOS_URL_QR.intersection(vals):
+            vals = dict(vals, qr_pendiente=True)
+        claves = []
+        if CAMPOS_ULTIMO_CERTIFICADO.intersection(vals):
+            claves = self._claves_ultimo_certificado()
+        res = super(InformesEncuestasMerge, self).write(vals)
+        if claves:
+            self.env['certifica.portal.ultimo.certificado'].sudo()._actualizar(claves + self._claves_ultimo_certificado())
+        return res
+
+    def unlink(self):
+        claves = self._claves_ultimo_certificado()
+        res = super(InformesEncuestasMerge, self).unlink()
+        self.env['certifica.portal.ultimo.certificado'].sudo()._actualizar(claves)
+        return res
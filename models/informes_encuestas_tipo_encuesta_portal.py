@@ -0,0 +1,37 @@
+from logging import getLogger
+
+from odoo import api, models, tools
+
+_logger = getLogger(__name__)
+
+
+class InformesEncuestasTipoEncuestaPortal(models.Model):
+    _inherit = 'informes.encuestas.tipo.encuesta.portal'
+
+    @api.model
+    @tools.ormcache('code')
+    def _portal_tipo_id(self, code):
+        return self.sudo().search([('active', '=', True),('code', '=', code)], limit=1).id
+
+    @api.model
+    @tools.ormcache('self.env.lang')
+    def _portal_tipos_activos(self):
+        # (id, code, title) de los tipos activos, en el orden del modelo
+        tipos = self.sudo().search([('active', '=', True)])
+        return tuple((tipo.id, tipo.code, tipo.title) for tipo in tipos)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super(InformesEncuestasTipoEncuestaPortal, self).create(vals_list)
+        self.clear_caches()
+        return records
+
+    def write(self, vals):
+        res = super(InformesEncuestasTipoEncuestaPortal, self).write(vals)
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super(InformesEncuestasTipoEncuestaPortal, self).unlink()
+        self.clear_caches()
+        return res
@@ -0,0 +1,33 @@
+from logging import getLogger
+
+from reportlab.graphics.barcode import createBarcodeDrawing
+import base64
+
+_logger = getLogger(__name__)
+
+# Tamaño del QR en píxeles y etiquetas por fila en la hoja de etiquetas
+QR_TAMANOS = {
+    'print_qr15': (63, 8),
+    'print_qr35': (147, 4),
+    'print_qr50': (210, 3),
+    'print_qr95': (370, 1),
+}
+# Campos de informes.encuestas.merge donde se guarda cada tamaño (informes QR del backend)
+QR_CAMPOS = {
+    'print_qr15': 'qr_code15',
+    'print_qr35': 'qr_code35',
+    'print_qr50': 'qr_code50',
+    'print_qr95': 'qr_code95',
+}
+
+
+def generar_qr_png(value, size):
+    # Mismo generador que /report/barcode, pero sin pasar por HTTP
+    drawing = createBarcodeDrawing('QR', value=value, format='png', width=size, height=size, barBorder=4)
+    return drawing.asString('png')
+
+
+def generar_qr_lote(values, size):
+    # Devuelve las imágenes en base64 en el mismo orden que values. Se genera en el propio proceso:
+    # crear procesos dentro de un worker de Odoo duplica su memoria y sus conexiones abiertas.
+    return [base64.b64encode(generar_qr_png(value, size)).decode() for value in values]
@@ -0,0 +1,36 @@
+odoo.define('custom_certifica_portal.certificados', function (require) {
+'use strict';
+
+var publicWidget = require('web.public.widget');
+
+// Carga la siguiente página del historial de certificados en el detalle del equipo/persona
+publicWidget.registry.CertificadosVerMas = publicWidget.Widget.extend({
+    selector: '.o_certificados_mas',
+    events: {
+        'click': '_onClick',
+    },
+
+    _onClick: function (ev) {
+        ev.preventDefault();
+        var self = this;
+        if (this.cargando) {
+            return;
+        }
+        this.cargando = true;
+        this._rpc({
+            route: this.$el.data('url'),
+            params: {offset: this.$el.data('offset')},
+        }).then(function (result) {
+            self.cargando = false;
+            self.$el.closest('.o_portal_html_view').find('tbody.o_certificados_filas').append(result.html);
+            if (result.mas) {
+                self.$el.data('offset', result.offset);
+            } else {
+                self.$el.parent().remove();
+            }
+        }).guardedCatch(function () {
+            self.cargando = false;
+        });
+    },
+});
+});
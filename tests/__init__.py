@@ -0,0 +1,2 @@
+from . import test_portal_rendimiento
+from . import test_vencimientos
@@ -0,0 +1,226 @@
+from logging import getLogger
+
+from odoo import fields
+from odoo.tests import HttpCase, tagged
+import base64
+import datetime
+import json
+import os
+import re
+import time
+import tracemalloc
+
+_logger = getLogger(__name__)
+
+PREFIJO = 'BENCH'
+ITERACIONES = 5
+# Tolerancia sobre el p95 y la memoria de la línea base guardada
+TOLERANCIA = 0.25
+# Línea base de tiempos: CERTIFICA_BENCH_BASELINE=/ruta.json; con CERTIFICA_BENCH_GUARDAR=1 se sobrescribe
+BASELINE = os.environ.get('CERTIFICA_BENCH_BASELINE')
+GUARDAR_BASELINE = bool(os.environ.get('CERTIFICA_BENCH_GUARDAR'))
+# Volumen de la medición contra la línea base: clientes x equipos/personas x certificados
+CLIENTES = int(os.environ.get('CERTIFICA_BENCH_CLIENTES', 5))
+ACTIVOS = int(os.environ.get('CERTIFICA_BENCH_ACTIVOS', 200))
+CERTIFICADOS = int(os.environ.get('CERTIFICA_BENCH_CERTIFICADOS', 6))
+
+
+# Rendimiento de las rutas del portal sobre datos sintéticos creados en la transacción del test.
+# Falla si una ruta responde con error, si el número de consultas SQL crece al crecer los datos
+# (N+1) o, con línea base, si el p95 o la memoria empeoran más de TOLERANCIA.
+#   odoo-bin -d prueba -i custom_certifica_portal --test-tags certifica_rendimiento --stop-after-init
+@tagged('post_install', '-at_install', 'certifica_rendimiento')
+class TestPortalRendimiento(HttpCase):
+
+    def setUp(self):
+        super(TestPortalRendimiento, self).setUp()
+        self.env['ir.config_parameter'].sudo().set_param('custom_certifica_portal.server_timing', 'True')
+        # Un tipo de equipos propio del test y el de personas (el portal lo reconoce por su código)
+        self.tipo = self._tipo('bench_equipos', 'Equipos benchmark')
+        self.tipo_personas = self._tipo('personas', 'Personas')
+        Maquinarias = self.env['informes.encuestas.maquinarias']
+        marcas = self.env[Maquinarias._fields['marca_id'].comodel_name]
+        equipotipos = self.env[Maquinarias._fields['equipotipo_id'].comodel_name]
+        self.marcas = marcas.create([{'name': '%s marca %s' % (PREFIJO, i)} for i in range(5)])
+        self.equipotipos = equipotipos.create([{'name': '%s tipo %s' % (PREFIJO, i)} for i in range(5)])
+        self.patrones = self.env['informes.encuestas.equipos'].create([{
+            'name': '%s patrón %s' % (PREFIJO, i),
+            'certificado_calibracion': self._pdf_sintetico(50),
+        } for i in range(4)])
+        self.clientes = self.env['res.partner']
+        self.usuarios = {}
+        # {cliente_id: recordset} de equipos y personas sembrados
+        self.equipos = {}
+        self.personas = {}
+
+    def _tipo(self, code, title):
+        Tipo = self.env['informes.encuestas.tipo.encuesta.portal']
+        tipo = Tipo.search([('active', '=', True), ('code', '=', code)], limit=1)
+        return tipo or Tipo.create({'name': title, 'code': code, 'title': title, 'active': True})
+
+    def _pdf_sintetico(self, kb):
+        return base64.b64encode(b'%PDF-1.4\n%' + os.urandom(max(kb, 1) * 1024) + b'\n%%EOF\n')
+
+    def _sembrar(self, clientes, activos, certificados):
+        # clientes nuevos, cada uno con `activos` equipos y `activos` personas de `certificados` certificados
+        for n in range(clientes):
+            numero = len(self.clientes)
+            cliente = self.env['res.partner'].create({'name': '%s cliente %s' % (PREFIJO, numero), 'is_company': True})
+            self.clientes |= cliente
+            self.usuarios[cliente.id] = self.env['res.users'].create({
+                'name': cliente.name,
+                'login': '%s_cliente_%s' % (PREFIJO.lower(), numero),
+                'password': '%s_cliente_%s' % (PREFIJO.lower(), numero),
+                'partner_id': self.env['res.partner'].create({
+                    'name': '%s usuario %s' % (PREFIJO, numero), 'parent_id': cliente.id}).id,
+                'groups_id': [(6, 0, [self.env.ref('base.group_portal').id])],
+            })
+            self.equipos[cliente.id] = self.env['informes.encuestas.maquinarias']
+            self.personas[cliente.id] = self.env['res.partner']
+            self._ampliar(cliente, activos, certificados)
+
+    def _ampliar(self, cliente, activos, certificados):
+        # `activos` equipos y personas más para un cliente ya sembrado
+        inicio = len(self.equipos[cliente.id])
+        equipos = self.env['informes.encuestas.maquinarias'].create([{
+            'name': '%s-%s-%s' % (PREFIJO, cliente.id, inicio + i),
+            'modelo': 'Modelo %s' % i,
+            'sku': 'SKU%06d' % (inicio + i),
+            'marca_id': self.marcas[i % len(self.marcas)].id,
+            'equipotipo_id': self.equipotipos[i % len(self.equipotipos)].id,
+        } for i in range(activos)])
+        personas = self.env['res.partner'].create([{
+            'name': '%s persona %s-%s' % (PREFIJO, cliente.id, inicio + i),
+            'parent_id': cliente.id,
+        } for i in range(activos)])
+        self.equipos[cliente.id] |= equipos
+        self.personas[cliente.id] |= personas
+        self._sembrar_certificados(cliente, equipos, certificados)
+        self._sembrar_certificados(cliente, personas, certificados, personas=True)
+
+    def _sembrar_certificados(self, cliente, activos, certificados, personas=False):
+        hoy = fields.Date.today()
+        self.env['informes.encuestas.merge'].create([{
+            'cliente_id': cliente.id,
+            'xtipodocumento': (self.tipo_personas if personas else self.tipo).id,
+            'personas_id' if personas else 'xmaquinaria': activo.id,
+            'codigocliente': '%s-%s-%s-%s' % (PREFIJO, 'P' if personas else 'E', activo.id, k),
+            'sedecliente': 'Sede %s' % (activo.id % 3),
+            'fecha_monitoreo': hoy - datetime.timedelta(days=30 * (k + 1)),
+            'fecha_vigencia': hoy + datetime.timedelta(days=365 - 30 * k),
+            'x_certificado_publicado_file': self._pdf_sintetico(50),
+            'equipos_ids': [(6, 0, self.patrones[:2].ids)],
+        } for activo in activos for k in range(certificados)])
+
+    def _rutas(self, cliente):
+        code = self.tipo.code
+        equipo = self.equipos[cliente.id][0]
+        persona = self.personas[cliente.id][0]
+        UltimoCertificado = self.env['certifica.portal.ultimo.certificado']
+        certificado = UltimoCertificado._buscar(cliente.id, self.tipo.id, equipo.id)
+        certificado_persona = UltimoCertificado._buscar(cliente.id, self.tipo_personas.id, persona.id, personas=True)
+        return [
+            ('layout', '/my/home'),
+            ('listado', '/my/%s' % code),
+            ('listado_pagina', '/my/%s/page/2' % code),
+            ('busqueda', '/my/%s?search=%s&search_in=all' % (code, PREFIJO)),
+            ('detalle', '/my/%s/%s' % (code, equipo.id)),
+            ('descarga_actual', '/web/certificado_current/download_pdf/%s' % certificado.id),
+            ('descarga_ultimo', '/web/ultimocertificado/%s/%s/%s' % (code, equipo.id, cliente.id)),
+            ('descarga_patron', '/web/equipos/download_pdf/%s' % self.patrones[0].id),
+            ('etiqueta_qr', '/web/ultimocertificado/%s/%s/%s/print_qr35' % (code, equipo.id, cliente.id)),
+            ('etiquetas_lote', '/my/%s/etiquetas/print_qr35' % code),
+            ('personas_listado', '/my/personas'),
+            ('personas_detalle', '/my/personas/%s' % persona.id),
+            ('personas_descarga_ultimo', '/web/ultimocertificado/personas/%s/%s' % (persona.id, cliente.id)),
+            ('personas_etiqueta_qr', '/web/ultimocertificado/personas/%s/%s/print_qr35/%s' % (
+                persona.id, cliente.id, certificado_persona.id)),
+            ('personas_etiquetas_lote', '/my/personas/etiquetas/print_qr35'),
+        ]
+
+    def _medir(self, cliente, iteraciones=ITERACIONES):
+        # {ruta: métricas} vistas por el usuario del cliente; las descargas siguen la redirección a
+        # la URL versionada y se suman las consultas de todas las respuestas
+        usuario = self.usuarios[cliente.id]
+        self.authenticate(usuario.login, usuario.login)
+        resultados = {}
+        for nombre, url in self._rutas(cliente):
+            tiempos, consultas = [], []
+            tracemalloc.start()
+            for i in range(iteraciones):
+                inicio = time.time()
+                response = self.url_open(url, timeout=120)
+                tiempos.append((time.time() - inicio) * 1000)
+                total = 0
+                for respuesta in list(response.history) + [response]:
+                    match = re.search(r'desc="(\d+) queries"', respuesta.headers.get('Server-Timing', ''))
+                    total += int(match.group(1)) if match else 0
+                consultas.append(total)
+            memoria_pico = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.assertIn(response.status_code, (200, 202), '%s respondió %s' % (nombre, response.status_code))
+            tiempos.sort()
+            resultados[nombre] = {
+                'status': response.status_code,
+                'p50_ms': round(self._percentil(tiempos, 50), 1),
+                'p95_ms': round(self._percentil(tiempos, 95), 1),
+                'p99_ms': round(self._percentil(tiempos, 99), 1),
+                # La primera iteración calienta cachés; se toma la última
+                'consultas': consultas[-1],
+                'memoria_pico_kb': memoria_pico // 1024,
+            }
+            _logger.info('Benchmark %s: %s', nombre, resultados[nombre])
+        return resultados
+
+    def _percentil(self, valores, p):
+        if not valores:
+            return 0.0
+        k = (len(valores) - 1) * p / 100.0
+        i = int(k)
+        j = min(i + 1, len(valores) - 1)
+        return valores[i] + (valores[j] - valores[i]) * (k - i)
+
+    def _comparar(self, base, actual, tolerancia):
+        regresiones = []
+        for nombre, metricas in actual.items():
+            previo = base.get(nombre)
+            if not previo:
+                continue
+            for clave in ('p95_ms', 'memoria_pico_kb'):
+                if previo.get(clave) and metricas[clave] > previo[clave] * (1 + tolerancia):
+                    regresiones.append('%s %s: %s -> %s' % (nombre, clave, previo[clave], metricas[clave]))
+            if previo.get('consultas') is not None and metricas['consultas'] > previo['consultas']:
+                regresiones.append('%s consultas: %s -> %s' % (nombre, previo['consultas'], metricas['consultas']))
+        return regresiones
+
+    def test_consultas_no_crecen_con_los_datos(self):
+        # Dos páginas de listado y un historial de más de una página; luego más clientes, el triple de
+        # activos del cliente medido y más certificados de los activos del detalle: las consultas por
+        # ruta no deben aumentar
+        self._sembrar(clientes=2, activos=45, certificados=2)
+        cliente = self.clientes[0]
+        self._sembrar_certificados(cliente, self.equipos[cliente.id][:1], 20)
+        self._sembrar_certificados(cliente, self.personas[cliente.id][:1], 20, personas=True)
+        pocos = self._medir(cliente, iteraciones=2)
+        self._sembrar(clientes=3, activos=45, certificados=2)
+        self._ampliar(cliente, 90, 3)
+        self._sembrar_certificados(cliente, self.equipos[cliente.id][:1], 20)
+        self._sembrar_certificados(cliente, self.personas[cliente.id][:1], 20, personas=True)
+        muchos = self._medir(cliente, iteraciones=2)
+        for nombre, metricas in muchos.items():
+            self.assertLessEqual(metricas['consultas'], pocos[nombre]['consultas'],
+                                 '%s: %s consultas con más datos (antes %s)' % (
+                                     nombre, metricas['consultas'], pocos[nombre]['consultas']))
+
+    def test_tiempos_contra_linea_base(self):
+        if not BASELINE:
+            self.skipTest('Defina CERTIFICA_BENCH_BASELINE para comparar tiempos con una línea base.')
+        self._sembrar(clientes=CLIENTES, activos=ACTIVOS, certificados=CERTIFICADOS)
+        resultados = self._medir(self.clientes[0])
+        if GUARDAR_BASELINE or not os.path.exists(BASELINE):
+            with open(BASELINE, 'w') as f:
+                json.dump(resultados, f, indent=2, sort_keys=True)
+            return
+        with open(BASELINE) as f:
+            regresiones = self._comparar(json.load(f), resultados, TOLERANCIA)
+        self.assertFalse(regresiones, 'Regresiones de rendimiento:\n%s' % '\n'.join(regresiones))
@@ -0,0 +1,68 @@
+from odoo import fields
+from odoo.tests import TransactionCase, tagged
+import datetime
+
+
+# Mantenimiento incremental (+/-1) del resumen de vencimientos al crear, mover de sede y archivar
+# certificados; el resultado debe coincidir con el recálculo completo
+@tagged('post_install', '-at_install')
+class TestVencimientos(TransactionCase):
+
+    def setUp(self):
+        super(TestVencimientos, self).setUp()
+        self.Vencimiento = self.env['certifica.portal.vencimiento']
+        self.Merge = self.env['informes.encuestas.merge']
+        self.tipo = self.env['informes.encuestas.tipo.encuesta.portal'].create({
+            'name': 'Vencimientos test', 'code': 'vencimientos_test', 'title': 'Vencimientos test', 'active': True,
+        })
+        self.cliente = self.env['res.partner'].create({'name': 'Cliente vencimientos', 'is_company': True})
+        self.equipos = self.env['informes.encuestas.maquinarias'].create([
+            {'name': 'VENC-%s' % i} for i in range(2)])
+        self.hoy = fields.Date.today()
+        # Grupo calculado hoy y vacío: los cambios siguientes se aplican como deltas
+        self.assertEqual(self.Vencimiento._resumen(self.cliente.id, self.tipo.id), {})
+
+    def _certificado(self, equipo, dias, sedecliente):
+        return self.Merge.create({
+            'cliente_id': self.cliente.id,
+            'xtipodocumento': self.tipo.id,
+            'xmaquinaria': equipo.id,
+            'codigocliente': 'VENC-%s-%s' % (equipo.id, dias),
+            'fecha_vigencia': self.hoy + datetime.timedelta(days=dias),
+            'sedecliente': sedecliente,
+        })
+
+    def _filas(self):
+        self.Vencimiento.invalidate_cache()
+        filas = self.Vencimiento.search([('cliente_id', '=', self.cliente.id), ('xtipodocumento', '=', self.tipo.id)])
+        self.assertTrue(all(fila.fecha_calculo == self.hoy for fila in filas))
+        return {(fila.sedecliente or '', fila.tramo): fila.cantidad for fila in filas}
+
+    def _assert_conteos(self, esperado):
+        self.assertEqual(self._filas(), esperado)
+        # Mismo resultado que agregando todo el grupo desde cero
+        self.Vencimiento._recalcular([(self.cliente.id, self.tipo.id)])
+        self.assertEqual(self._filas(), esperado)
+
+    def test_deltas(self):
+        certificado = self._certificado(self.equipos[0], 10, 'Norte')
+        self._assert_conteos({('Norte', '30'): 1})
+
+        self._certificado(self.equipos[1], 45, 'Norte')
+        self._assert_conteos({('Norte', '30'): 1, ('Norte', '60'): 1})
+
+        certificado.write({'sedecliente': 'Sur'})
+        self._assert_conteos({('Sur', '30'): 1, ('Norte', '60'): 1})
+
+        # Un certificado más nuevo del mismo equipo reemplaza al anterior en su tramo
+        nuevo = self._certificado(self.equipos[0], 80, False)
+        self._assert_conteos({('', '90'): 1, ('Norte', '60'): 1})
+
+        if 'active' in self.Merge._fields:
+            nuevo.write({'active': False})
+        else:
+            nuevo.unlink()
+        self._assert_conteos({('Sur', '30'): 1, ('Norte', '60'): 1})
+
+        certificado.write({'fecha_vigencia': self.hoy - datetime.timedelta(days=1)})
+        self._assert_conteos({('Sur', 'vencido'): 1, ('Norte', '60'): 1})